@@ -0,0 +1,402 @@
+"""
+Repeatable benchmark suite for every poison endpoint
+Drives the API in-process through the Flask test client and/or against a locally launched server,
+at several corpus and buffer sizes, and reports throughput, p50/p99 latency and the process's peak RSS so far
+
+Every run works on a scratch copy of src/, so the real buffers are never touched
+
+Example usage (from src/services):
+python benchmarks/bench_poison.py --mode both --corpus-sizes 0,1000,10000 --save-baseline
+python benchmarks/bench_poison.py --compare
+"""
+
+### Imports
+# Standard
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+# Third Party
+import requests
+
+# Local (app modules are imported from the scratch workspace at runtime)
+
+
+
+SERVICES_DIRECTORY: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIRECTORY: str = os.path.join(SERVICES_DIRECTORY, "src")
+SAMPLES_DIRECTORY: str = os.path.join(SERVICES_DIRECTORY, "..", "..", "dev-help", "samples-input")
+SAMPLE_IMAGE: str = os.path.join(SAMPLES_DIRECTORY, "rhino_owl_mask_gridview.jpeg")
+SAMPLE_AUDIO: str = os.path.join(SAMPLES_DIRECTORY, "minecraft_eating_sound_effect_8s.mp3")
+DEFAULT_CORPUS: str = os.path.join(SOURCE_DIRECTORY, "data", "buffer", "corpora", "zzz.default_corpus.txt")
+DEFAULT_BASELINE: str = os.path.join(SERVICES_DIRECTORY, "benchmarks", "baselines", "baseline.json")
+BUFFER_SUBDIRECTORIES: tuple[str, ...] = ("data/buffer/audio", "data/buffer/corpora", "data/buffer/images", "data/intake", "data/out-for-delivery")
+SYNTHETIC_SEED: int = 485
+
+
+
+class InProcessClient:
+    """
+    Issues requests through the Flask test client
+    """
+    label = "inprocess"
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method: str, path: str, json_body: dict | None = None, upload: tuple[str, str] | None = None) -> int:
+        if not upload:
+            response = self.client.open(path, method = method, json = json_body)
+        else:
+            field, file_path = upload
+            with open(file_path, "rb") as upload_file:
+                response = self.client.open(path, method = method, json = json_body, data = {field: (upload_file, os.path.basename(file_path))})
+        response.get_data()
+        # a real server closes every response once sent, which is what frees its delivery slot
+        response.close()
+        return response.status_code
+
+    def peakRssMegabytes(self) -> float:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS and kilobytes everywhere else
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+
+class ServerClient:
+    """
+    Issues requests over HTTP to a locally launched server process
+    """
+    label = "server"
+
+    def __init__(self, base_url: str, process: subprocess.Popen):
+        self.base_url = base_url
+        self.process = process
+        self.session = requests.Session()
+
+    def request(self, method: str, path: str, json_body: dict | None = None, upload: tuple[str, str] | None = None) -> int:
+        if not upload:
+            return self.session.request(method, self.base_url + path, json = json_body, timeout = 120).status_code
+        field, file_path = upload
+        with open(file_path, "rb") as upload_file:
+            response = self.session.request(method, self.base_url + path, json = json_body, files = {field: (os.path.basename(file_path), upload_file)}, timeout = 120)
+        return response.status_code
+
+    def peakRssMegabytes(self) -> float:
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return float("nan") # only available on Linux
+
+
+
+def prepareWorkspace(workspace: str, corpus_size: int):
+    """
+    Resets a scratch copy of src/ to empty buffers plus corpus_size synthetic corpus files
+    The same path is reused across corpus sizes, since the in-process app resolves served files against its import location
+    """
+    if not os.path.exists(workspace):
+        shutil.copytree(SOURCE_DIRECTORY, workspace, ignore = shutil.ignore_patterns("__pycache__"))
+    for subdirectory in BUFFER_SUBDIRECTORIES:
+        directory = os.path.join(workspace, subdirectory)
+        for entry in os.listdir(directory):
+            if entry not in (".gitkeep", "zzz.default_corpus.txt"):
+                os.remove(os.path.join(directory, entry))
+
+    # synthetic corpora are seeded samples of the default corpus, so every run trains on identical text
+    with open(DEFAULT_CORPUS) as default_corpus:
+        lines = [line.strip() for line in default_corpus if line.strip()]
+    rng = random.Random(SYNTHETIC_SEED)
+    corpora_directory = os.path.join(workspace, "data", "buffer", "corpora")
+    for i in range(corpus_size):
+        with open(os.path.join(corpora_directory, f"corpus_{i:06d}"), "w") as corpus_file:
+            corpus_file.write(" ".join(rng.sample(lines, rng.randint(3, 8))))
+
+
+
+def startInProcess(workspace: str, first: bool) -> tuple[InProcessClient, float]:
+    """
+    Points the in-process app at the given workspace, importing it on first use
+    Returns the client and the seconds spent on startup (model training and buffer init)
+    """
+    os.chdir(workspace)
+    start = time.perf_counter()
+    # trimDirectory prints every filename it sees, which would bury the report at 10k corpora
+    with contextlib.redirect_stdout(io.StringIO()):
+        if first:
+            sys.path.insert(0, workspace)
+            import app
+        else:
+            import app
+            import global_vars
+            from core.markov import initMarkovGenerator
+            from core.filehandling import initializeFileBuffers
+            global_vars.corpus_count = 0
+            initMarkovGenerator()
+            initializeFileBuffers()
+    return InProcessClient(app.app), time.perf_counter() - start
+
+
+
+def startServer(workspace: str, startup_timeout: float) -> tuple[ServerClient, float]:
+    """
+    Launches flask in the given workspace on a free port and waits until it answers
+    Returns the client and the seconds spent on startup
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    environment = dict(os.environ, LOG_MIN_LEVEL = "ERROR")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--no-reload", "--no-debugger"],
+        cwd = workspace, env = environment, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    while time.perf_counter() - start < startup_timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server in '{workspace}' exited during startup with code {process.returncode}")
+        try:
+            requests.get(base_url + "/poison/text", timeout = 1)
+            return ServerClient(base_url, process), time.perf_counter() - start
+        except requests.exceptions.RequestException:
+            time.sleep(0.25)
+    process.kill()
+    raise RuntimeError(f"Server in '{workspace}' did not answer within {startup_timeout} seconds")
+
+
+
+def buildCases(buffer_fills: list[int], audio_available: bool) -> list[tuple[str, Callable, Callable]]:
+    """
+    Returns (name, prepare, run) for every benchmark case
+    prepare(client) runs untimed before the case, run(client) is timed each iteration and returns a status code
+    """
+    rng = random.Random(SYNTHETIC_SEED)
+    with open(DEFAULT_CORPUS) as default_corpus:
+        lines = [line.strip() for line in default_corpus if line.strip()]
+
+    noop = lambda client: None
+    cases: list[tuple[str, Callable, Callable]] = [
+        ("text_get", noop, lambda client: client.request("GET", "/poison/text", {"numsentences": 3})),
+        ("text_post", noop, lambda client: client.request("POST", "/poison/text", {"content": " ".join(rng.sample(lines, 4))})),
+        ("image_post", noop, lambda client: client.request("POST", "/poison/images", upload = ("image", SAMPLE_IMAGE))),
+    ]
+
+    # GETs are served from a buffer held at a fixed fill level by an untimed upload each iteration
+    def fillImages(count: int) -> Callable:
+        return lambda client: [client.request("POST", "/poison/images", upload = ("image", SAMPLE_IMAGE)) for _ in range(count)]
+
+    def serveImage(client) -> tuple[int, float]:
+        client.request("POST", "/poison/images", upload = ("image", SAMPLE_IMAGE))
+        start = time.perf_counter()
+        status = client.request("GET", "/poison/images")
+        return status, time.perf_counter() - start
+
+    for fill in buffer_fills:
+        cases.append((f"image_get[buffer={fill}]", fillImages(fill), serveImage))
+
+    if audio_available:
+        def fillAudio(count: int) -> Callable:
+            return lambda client: [client.request("POST", "/poison/audio", upload = ("audio", SAMPLE_AUDIO)) for _ in range(count)]
+
+        def serveClip(client) -> tuple[int, float]:
+            client.request("POST", "/poison/audio", upload = ("audio", SAMPLE_AUDIO))
+            start = time.perf_counter()
+            status = client.request("GET", "/poison/audio", {"clip_duration": 3})
+            return status, time.perf_counter() - start
+
+        cases.append(("audio_post", noop, lambda client: client.request("POST", "/poison/audio", upload = ("audio", SAMPLE_AUDIO))))
+        for fill in buffer_fills:
+            cases.append((f"audio_clip[buffer={fill}]", fillAudio(fill), serveClip))
+
+    return cases
+
+
+
+def runCase(client, prepare: Callable, run: Callable, iterations: int, warmup: int) -> dict:
+    """
+    Runs one case and summarizes throughput, latency percentiles, failures and peak RSS
+    Only successful (2xx) iterations count towards latency and throughput, so fast error or 429 answers can't pass for serving
+    Peak RSS is the process high-water mark after the case, so it also covers every case run before it in the same process
+    """
+    prepare(client)
+    for _ in range(warmup):
+        run(client)
+
+    latencies: list[float] = []
+    failures = 0
+    throttled = 0
+    case_start = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        outcome = run(client)
+        elapsed = time.perf_counter() - start
+        # cases with untimed setup inside the iteration report their own timing
+        if isinstance(outcome, tuple):
+            outcome, elapsed = outcome
+        if not 200 <= outcome < 300:
+            failures += 1
+            throttled += outcome == 429
+            continue
+        latencies.append(elapsed)
+    case_seconds = time.perf_counter() - case_start
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "failures": failures,
+        "throttled": throttled,
+        "throughput_rps": round(len(latencies) / sum(latencies), 2) if sum(latencies) else 0.0,
+        "wall_seconds": round(case_seconds, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "peak_rss_mb": round(client.peakRssMegabytes(), 1),
+    }
+
+
+
+def percentile(sorted_values: list[float], rank: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(rank / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+
+def compareToBaseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Lists every case whose latency regressed past the tolerance, or whose throughput fell below it
+    A case with failed iterations always counts as a regression, its timings don't describe the same work
+    """
+    regressions: list[str] = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if current["failures"]:
+            regressions.append(f"{key}: {current['failures']} of {current['iterations']} iterations failed")
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {previous[metric]} -> {current[metric]}")
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput_rps {previous['throughput_rps']} -> {current['throughput_rps']}")
+    return regressions
+
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = "Benchmark every poison endpoint")
+    parser.add_argument("--mode", choices = ("inprocess", "server", "both"), default = "inprocess")
+    parser.add_argument("--corpus-sizes", default = "0,1000,10000", help = "comma-separated synthetic corpus file counts")
+    parser.add_argument("--buffer-fills", default = "1,5", help = "comma-separated media buffer fill levels for GET cases")
+    parser.add_argument("--iterations", type = int, default = 50)
+    parser.add_argument("--warmup", type = int, default = 3)
+    parser.add_argument("--startup-timeout", type = float, default = 1800.0, help = "seconds to wait for a server to finish training")
+    parser.add_argument("--baseline", default = DEFAULT_BASELINE, help = "baseline JSON file to save to or compare against")
+    parser.add_argument("--save-baseline", action = "store_true")
+    parser.add_argument("--compare", action = "store_true", help = "exit non-zero if any case regressed against the baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "allowed fractional regression before failing --compare")
+    parser.add_argument("--output", help = "also write this run's results to the given JSON file")
+    args = parser.parse_args()
+
+    corpus_sizes = [int(size) for size in args.corpus_sizes.split(",")]
+    buffer_fills = [int(fill) for fill in args.buffer_fills.split(",")]
+    modes = ("inprocess", "server") if args.mode == "both" else (args.mode,)
+    audio_available = shutil.which("ffmpeg") is not None
+    if not audio_available:
+        print("ffmpeg not found on PATH, skipping audio cases")
+
+    # keep the app's own logging out of the report, must be set before it is imported
+    os.environ["LOG_MIN_LEVEL"] = "ERROR"
+    original_directory = os.getcwd()
+    results: dict[str, dict] = {}
+    scratch_root = tempfile.mkdtemp(prefix = "inferno-bench-")
+    imported = False
+    try:
+        for mode in modes:
+            for corpus_size in corpus_sizes:
+                workspace = os.path.join(scratch_root, mode)
+                prepareWorkspace(workspace, corpus_size)
+                if mode == "inprocess":
+                    client, startup_seconds = startInProcess(workspace, not imported)
+                    imported = True
+                else:
+                    client, startup_seconds = startServer(workspace, args.startup_timeout)
+                print(f"\n[{mode}] corpus={corpus_size} startup {startup_seconds:.2f}s")
+                results[f"{mode}/corpus={corpus_size}/startup"] = {"startup_seconds": round(startup_seconds, 3)}
+                try:
+                    for name, prepare, run in buildCases(buffer_fills, audio_available):
+                        summary = runCase(client, prepare, run, args.iterations, args.warmup)
+                        results[f"{mode}/corpus={corpus_size}/{name}"] = summary
+                        print(f"  {name:<24} {summary['throughput_rps']:>9.2f} req/s  p50 {summary['p50_ms']:>9.3f}ms  p99 {summary['p99_ms']:>9.3f}ms  peak rss {summary['peak_rss_mb']:>7.1f}MB  failures {summary['failures']} (throttled {summary['throttled']})")
+                finally:
+                    if isinstance(client, ServerClient):
+                        client.process.terminate()
+                        client.process.wait()
+    finally:
+        os.chdir(original_directory)
+        shutil.rmtree(scratch_root, ignore_errors = True)
+
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), "iterations": args.iterations},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent = 2)
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at '{args.baseline}', run with --save-baseline first")
+            return 2
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compareToBaseline({key: value for key, value in results.items() if "p50_ms" in value}, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit_code = 1
+        else:
+            print("\nNo regressions against baseline")
+
+    failed_cases = [key for key, value in results.items() if value.get("failures")]
+    if args.save_baseline and failed_cases:
+        print(f"\nNot saving a baseline, these cases had failed iterations: {', '.join(failed_cases)}")
+        return 1
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok = True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent = 2)
+        print(f"Baseline saved to '{args.baseline}'")
+
+    return exit_code
+
+
+
+if __name__ == "__main__":
+    # served files sit on 30 second deletion timers, don't wait on them once the report is out
+    code = main()
+    sys.stdout.flush()
+    os._exit(code)
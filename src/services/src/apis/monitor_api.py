@@ -4,21 +4,40 @@ API definition for poisoner functions
 
 ### Imports
 # Standard
+import hmac
 from http import HTTPStatus
 
 # Third Party
 import requests
-from flask import jsonify
+from flask import Response, jsonify, request
 from flask_restx import Namespace, Resource
 
 # Local
 from core.messaging import console_out, LogLevel
+import core.tarpitstats
+import core.metrics
+import core.profiler
+import global_vars
 
 
 monitor_ns = Namespace("monitor", description="Tarpit monitoring operations")
 
 
 
+def requireAdmin():
+    """
+    Aborts unless the request carries the configured admin token in X-Admin-Token
+    Admin endpoints are disabled outright when no ADMIN_TOKEN is configured
+    """
+    if not global_vars.ADMIN_TOKEN:
+        monitor_ns.abort(403, "Admin endpoints are disabled: no ADMIN_TOKEN configured")
+    supplied = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(supplied.encode(), global_vars.ADMIN_TOKEN.encode()):
+        console_out("Rejected admin request with bad token", LogLevel.WARN)
+        monitor_ns.abort(403, "Invalid admin token")
+
+
+
 @monitor_ns.route("/current/<path:catchall_path>")
 class TarpitQueryPassthroughAPI(Resource):
     """
@@ -34,13 +53,122 @@ class TarpitQueryPassthroughAPI(Resource):
         IP Addresses - /monitor/current/stats/addresses
         Complete Log - /monitor/current/stats/buffer
         You can request results after a given request with id X, you can suffix from/<X> to any of the above endpoints 
+        Results are cached for a couple of seconds, and the complete log is served from a local mirror of the tarpit log
         """
-        print(catchall_path)
+        console_out(f"Tarpit passthrough: {catchall_path}", LogLevel.USAGE)
         try:
-            response = requests.get("http://division-la.gl.at.ply.gg:8666/" + catchall_path)
-            response.raise_for_status()  # Raise an exception for bad status codes
-            data = response.json()
+            data = core.tarpitstats.queryTarpit(catchall_path)
             return jsonify(data)
         except requests.exceptions.RequestException as e:
             return jsonify({'error': str(e)}), 500
 
+
+
+@monitor_ns.route("/metrics")
+class MetricsAPI(Resource):
+    """
+    API for scraping service metrics in Prometheus text format
+    """
+
+    def get(self):
+        r"""
+        Returns request latency, markov and ffmpeg timing histograms, plus live buffer gauges
+
+        Example usage:
+        curl -X GET \
+            127.0.0.1:5000/monitor/metrics
+        """
+        return Response(core.metrics.renderMetrics(), mimetype = "text/plain; version=0.0.4")
+
+
+
+profiler_parser = monitor_ns.parser()
+profiler_parser.add_argument("fraction", 
+                             type=float)
+profiler_parser.add_argument("duration", 
+                             type=float)
+profiler_parser.add_argument("interval_ms", 
+                             type=float)
+
+@monitor_ns.route("/profiler")
+class ProfilerAPI(Resource):
+    """
+    Admin API for sampling live requests with a low-overhead stack profiler
+    All methods require the X-Admin-Token header
+    """
+
+    def get(self):
+        r"""
+        Return the status of the current or most recent capture
+
+        Example usage:
+        curl -X GET \
+            -H "X-Admin-Token: <token>" \
+            127.0.0.1:5000/monitor/profiler
+        """
+        requireAdmin()
+        return core.profiler.captureStatus()
+
+    @monitor_ns.expect(profiler_parser)
+    def post(self):
+        r"""
+        Start a capture, replacing any previous one
+        "fraction" of requests (0 < X <= 1, default 0.1) are sampled every "interval_ms" (default 5) for "duration" seconds (max 600, default 60)
+        A fraction of 0 or less disables profiling: any running capture is stopped and none is started
+
+        Example usage:
+        curl -X POST \
+            -H "X-Admin-Token: <token>" \
+            -H "Content-Type: application/json" \
+            -d '{"fraction": 0.25, "duration": 120}' \
+            127.0.0.1:5000/monitor/profiler
+        """
+        requireAdmin()
+        args = profiler_parser.parse_args()
+        fraction = args["fraction"] if args["fraction"] is not None else global_vars.PROFILER_DEFAULT_FRACTION
+        if fraction <= 0:
+            core.profiler.stopCapture()
+            return core.profiler.captureStatus()
+        if fraction > 1: fraction = 1.0
+        duration = args["duration"] or global_vars.PROFILER_DEFAULT_DURATION
+        if duration < 1: duration = 1
+        if duration > global_vars.PROFILER_MAX_DURATION: duration = global_vars.PROFILER_MAX_DURATION
+        interval = (args["interval_ms"] or global_vars.PROFILER_SAMPLE_INTERVAL * 1000) / 1000
+        if interval < 0.001: interval = 0.001
+        return core.profiler.startCapture(fraction, duration, interval), 201
+
+    def delete(self):
+        r"""
+        Stop the running capture early, keeping the stacks collected so far
+
+        Example usage:
+        curl -X DELETE \
+            -H "X-Admin-Token: <token>" \
+            127.0.0.1:5000/monitor/profiler
+        """
+        requireAdmin()
+        core.profiler.stopCapture()
+        return core.profiler.captureStatus()
+
+
+
+@monitor_ns.route("/profiler/stacks")
+class ProfilerStacksAPI(Resource):
+    """
+    Admin API for downloading captured stacks
+    """
+
+    def get(self):
+        r"""
+        Download the aggregated stacks in collapsed-stack format, ready for flamegraph.pl or speedscope
+
+        Example usage:
+        curl --fail --output profile.folded -X GET \
+            -H "X-Admin-Token: <token>" \
+            127.0.0.1:5000/monitor/profiler/stacks
+        flamegraph.pl profile.folded > profile.svg
+        """
+        requireAdmin()
+        response = Response(core.profiler.collapsedStacks(), mimetype = "text/plain")
+        response.headers["Content-Disposition"] = 'attachment; filename="profile.folded"'
+        return response
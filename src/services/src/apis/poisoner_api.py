@@ -4,19 +4,27 @@ API definition for poisoner functions
 
 ### Imports
 # Standard
+import hashlib
 import random
 from http import HTTPStatus
 
 # Third Party
-from flask import request, send_file
+import markovify
+from flask import Response, request, send_file
 from flask_restx import Namespace, Resource
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge, TooManyRequests
 
 # Local
 from core.messaging import console_out, LogLevel
 import core.markov
+from core.overlap import ShingleIndex
 import core.images
 import core.audio
+import core.filehandling
+import core.admission
+import core.pages
+import global_vars
 
 
 poison_ns = Namespace("poison", description="Poisoning operations")
@@ -30,6 +38,8 @@ text_in_parser.add_argument("content",
 text_out_parser = poison_ns.parser()
 text_out_parser.add_argument("numsentences", 
                              type=int)
+text_out_parser.add_argument("seed", 
+                             type=str)
 
 @poison_ns.route("/text")
 class PoisonTextApi(Resource):
@@ -50,9 +60,13 @@ class PoisonTextApi(Resource):
             -d '{"content": "This is an example sentence to be uploaded to the markov chain."}' \
             127.0.0.1:5000/poison/text
         """
-        args = text_in_parser.parse_args()
-        # Add to the model.
-        core.markov.addToCorpus(args["content"])
+        work_queue = _admit("text")
+        try:
+            args = text_in_parser.parse_args()
+            # Add to the model.
+            core.markov.addToCorpus(args["content"])
+        finally:
+            work_queue.release()
         return "Resource added", 201
     
     @poison_ns.expect(text_out_parser)
@@ -62,24 +76,32 @@ class PoisonTextApi(Resource):
         Pass number of sentences in JSON as an int named "numsentences"
         If generating numsentences fails, it will try to fall back to 3 sentences. 
         If that also fails, it will return an error string.
+        Optionally pass a string named "seed" (JSON or query string): the same seed returns the same text until the model changes,
+        with an ETag and Cache-Control so proxies can cache it. Unseeded output is random and marked no-store.
 
         Example usage:
         curl -X GET \
             -H "Content-Type: application/json" \
             -d '{"numsentences": 5}' \
             127.0.0.1:5000/poison/text
+        curl -X GET \
+            "127.0.0.1:5000/poison/text?numsentences=5&seed=some-page-slug"
         """
         args = text_out_parser.parse_args()
         numsentences = args["numsentences"] or 3
         if numsentences < 1: numsentences = 1
         if numsentences > 100: numsentences = 100
-        # Pull sentences from the model
-        output = core.markov.getXSentences(numsentences)
-        # If it fails on user number, falls back to three sentences
-        # If that also fails, will return the error message
-        if output[:5] == "ERROR":
-            output = core.markov.getXSentences(3)
-        return output
+        seed = args["seed"]
+        if seed is None:
+            return _generateText(numsentences, None), 200, {"Cache-Control": "no-store"}
+
+        # the tag and the text both come from one snapshot, so an update mid-request can't pair new text with an old tag
+        text_model, shingle_index, model_version = core.markov.getModelSnapshot()
+        etag = _textETag(model_version, numsentences, seed)
+        headers = {"ETag": f'"{etag}"', "Cache-Control": f"public, max-age={global_vars.TEXT_CACHE_MAX_AGE}"}
+        if request.if_none_match.contains(etag):
+            return "", 304, headers
+        return _generateText(numsentences, seed, text_model, shingle_index), 200, headers
 
 
 
@@ -102,30 +124,39 @@ class PoisonImagesApi(Resource):
         r"""
         Adds input image (not link, actual image) to the poison buffer
         NOTE: does not poison images. Assumes they have been tampered with ahead of time.
+        Images are re-encoded (bounded size, progressive, metadata stripped) before buffering; the X-Bytes-Saved header reports the difference
+        Uploads over IMAGE_UPLOAD_MAX_BYTES are refused with a 413
 
         Example usage:
         curl -X POST \
             -F "image=@dev-help/samples-input/rhino_owl_mask_gridview.jpeg" \
             127.0.0.1:5000/poison/images
         """
-        if "image" not in request.files:
-            poison_ns.abort(400, "No image file provided")
+        _limitUploadSize(global_vars.IMAGE_UPLOAD_MAX_BYTES)
+        work_queue = _admit("images", intake = True)
+        try:
+            if "image" not in request.files:
+                poison_ns.abort(400, "No image file provided")
 
-        image_file = request.files["image"]
+            image_file = request.files["image"]
 
-        if not image_file.filename:
-            poison_ns.abort(400, "No selected file")
+            if not image_file.filename:
+                poison_ns.abort(400, "No selected file")
 
-        status = core.images.saveImageFromPost(image_file)
+            status = core.images.saveImageFromPost(image_file)
+        finally:
+            _finish(work_queue, intake = True)
         status_length = len(status)
-        if status_length == 1 and status[0] == 0:
-            return "Resource added", 201
+        if status_length == 3 and status[0] == 0:
+            return "Resource added", 201, {"X-Bytes-Saved": str(status[1] - status[2])}
         elif status_length == 2 and status[0] == 1:
             poison_ns.abort(500, f"Error processing image: {str(status[1])}")
         elif status_length == 1 and status[0] == 2:
             poison_ns.abort(400, f"Error processing image: must be jpg")
         elif status_length == 1 and status[0] == 3:
             poison_ns.abort(400, f"Error processing file: must be image file (jpg)")
+        elif status_length == 1 and status[0] == 4:
+            poison_ns.abort(400, f"Error processing image: could not be decoded")
         else:
             poison_ns.abort(500, f"Error processing image: bad function return") # this should never happen
         
@@ -139,6 +170,7 @@ class PoisonImagesApi(Resource):
         curl -v --output dev-help/samples-output/requested-img.jpg -X GET \
             127.0.0.1:5000/poison/images
         """
+        # a single claim and a file send: never queued or counted against delivery, so it stays fast under load
         image_path = core.images.getImageFromBuffer()
         console_out(f"Image Path: {image_path}", LogLevel.USAGE)
         if image_path == "File not found":
@@ -150,6 +182,54 @@ class PoisonImagesApi(Resource):
 
 
 
+image_batch_parser = poison_ns.parser()
+image_batch_parser.add_argument("count", 
+                                type=int)
+
+@poison_ns.route("/images/batch")
+class PoisonImagesBatchApi(Resource):
+    """
+    API for serving several poison images in one request
+    """
+
+    @poison_ns.expect(image_batch_parser)
+    def get(self):
+        r"""
+        Return a zip of X (1 <= X <= 50, default 5) images and remove them from the buffer
+        Pass number of images in JSON as an int named "count"
+        If the buffer holds fewer than X images, all of them are returned; the X-Asset-Count header gives the actual number
+
+        Example usage:
+        curl -v --fail --output dev-help/samples-output/requested-imgs.zip -X GET \
+            -H "Content-Type: application/json" \
+            -d '{"count": 5}' \
+            127.0.0.1:5000/poison/images/batch
+        """
+        args = image_batch_parser.parse_args()
+        count = args["count"] or 5
+        if count < 1: count = 1
+        if count > global_vars.BATCH_MAX_COUNT: count = global_vars.BATCH_MAX_COUNT
+
+        # the whole batch is one delivery, released once the stream has been sent, since that is where the work happens
+        _reserveDelivery()
+        try:
+            work_queue = _admit("images")
+        except:
+            core.admission.DELIVERY_LIMIT.release()
+            raise
+        try:
+            claimed, archive = core.images.getImageBatchFromBuffer(count)
+            console_out(f"Image batch: {len(claimed)} of {count}", LogLevel.USAGE)
+            if not claimed:
+                poison_ns.abort(404, "Image not found: server image buffer is currently empty, and default case is yet to be implemented.")
+        except:
+            _finish(work_queue, delivery = True)
+            raise
+
+        return _zipResponse(claimed, archive, "images.zip", work_queue)
+
+
+
 audio_in_parser = poison_ns.parser()
 audio_in_parser.add_argument("audio", 
                              type = FileStorage, 
@@ -179,15 +259,19 @@ class PoisonAudioApi(Resource):
             -F "audio=@dev-help/samples-input/rhino_owl_mask_gridview.jpeg" \
             127.0.0.1:5000/poison/audio
         """
-        if "audio" not in request.files:
-            poison_ns.abort(400, "No audio file provided")
+        work_queue = _admit("audio", intake = True)
+        try:
+            if "audio" not in request.files:
+                poison_ns.abort(400, "No audio file provided")
 
-        audio_file = request.files["audio"]
+            audio_file = request.files["audio"]
 
-        if not audio_file.filename:
-            poison_ns.abort(400, "No selected file")
+            if not audio_file.filename:
+                poison_ns.abort(400, "No selected file")
 
-        status = core.audio.saveAudioFromPost(audio_file)
+            status = core.audio.saveAudioFromPost(audio_file)
+        finally:
+            _finish(work_queue, intake = True)
         status_length = len(status)
         if status_length == 1 and status[0] == 0:
             return "Resource added", 201
@@ -220,11 +304,203 @@ class PoisonAudioApi(Resource):
         if clip_duration < 1: clip_duration = 1
         if clip_duration > 100: clip_duration = 100
 
-        audio_path = core.audio.getAudioFromBuffer(clip_duration)
+        # only the finished clip counts against delivery, held until it has been sent; its chunks are temporary
+        _reserveDelivery(1)
+        try:
+            work_queue = _admit("audio", intake = True)
+        except:
+            core.admission.DELIVERY_LIMIT.release()
+            raise
+        try:
+            audio_path = core.audio.getAudioFromBuffer(clip_duration)
+        except:
+            core.admission.DELIVERY_LIMIT.release()
+            raise
+        finally:
+            _finish(work_queue, intake = True)
         
         if audio_path == "File not found":
+            core.admission.DELIVERY_LIMIT.release()
             poison_ns.abort(404, "Audio not found: server audio buffer is currently empty.")
-        elif audio_path == "Bad path":
+        elif audio_path == "Invalid path(s)":
+            core.admission.DELIVERY_LIMIT.release()
             poison_ns.abort(500, f"Error serving audio: bad internal filepath")
-            
-        return send_file(audio_path, as_attachment = True)
+        elif audio_path[:len("Exception: ")] == "Exception: ":
+            core.admission.DELIVERY_LIMIT.release()
+            poison_ns.abort(500, f"Error processing audio: {audio_path[len('Exception: '):]}")
+
+        try:
+            response = send_file(audio_path, as_attachment = True)
+        except:
+            core.admission.DELIVERY_LIMIT.release()
+            raise
+        # the file itself stays for its timed deletion, but the slot only covers sending it
+        # a passthrough file response skips the close hooks, so the clip goes through the normal response iterator
+        response.direct_passthrough = False
+        response.call_on_close(core.admission.DELIVERY_LIMIT.release)
+        return response
+
+
+
+audio_batch_parser = poison_ns.parser()
+audio_batch_parser.add_argument("count", 
+                                type=int)
+audio_batch_parser.add_argument("clip_duration", 
+                                type=int)
+
+@poison_ns.route("/audio/batch")
+class PoisonAudioBatchApi(Resource):
+    """
+    API for serving several stitched audio clips in one request
+    """
+
+    @poison_ns.expect(audio_batch_parser)
+    def get(self):
+        r"""
+        Return a zip of X (1 <= X <= 50, default 5) stitched clips of Y (1 <= Y <= 100, default random 3-10) seconds each
+        Pass number of clips in JSON as an int named "count", and seconds per clip as an int named "clip_duration"
+        If the buffer runs short, fewer (and a shorter final) clips are returned; the X-Asset-Count header gives the actual number
+
+        Example usage:
+        curl -v --fail --output dev-help/samples-output/requested-audio.zip -X GET \
+            -H "Content-Type: application/json" \
+            -d '{"count": 3, "clip_duration": 5}' \
+            127.0.0.1:5000/poison/audio/batch
+        """
+        args = audio_batch_parser.parse_args()
+        count = args["count"] or 5
+        if count < 1: count = 1
+        if count > global_vars.BATCH_MAX_COUNT: count = global_vars.BATCH_MAX_COUNT
+        clip_duration = args["clip_duration"] or random.choice(range(3, 11))
+        if clip_duration < 1: clip_duration = 1
+        if clip_duration > 100: clip_duration = 100
+
+        # the whole batch is one delivery, released once the stream has been sent, since clips are encoded as it goes
+        _reserveDelivery()
+        try:
+            work_queue = _admit("audio")
+        except:
+            core.admission.DELIVERY_LIMIT.release()
+            raise
+        try:
+            claimed, archive = core.audio.getAudioBatchFromBuffer(count, clip_duration)
+            clip_count = -(-len(claimed) // clip_duration)
+            console_out(f"Audio batch: {clip_count} of {count}", LogLevel.USAGE)
+            if not claimed:
+                poison_ns.abort(404, "Audio not found: server audio buffer is currently empty.")
+        except:
+            _finish(work_queue, delivery = True)
+            raise
+
+        return _zipResponse(claimed, archive, "audio.zip", work_queue, clip_count)
+
+
+
+@poison_ns.route("/page", "/page/<path:slug>")
+class PoisonPageApi(Resource):
+    """
+    API for serving complete generated html pages
+    """
+
+    @poison_ns.response(HTTPStatus.OK.value, "Page rendered")
+    def get(self, slug: str | None = None):
+        r"""
+        Return a full html page of markov paragraphs, with embedded image/audio references and links to further generated pages
+        Any slug is accepted and ignored, so every link on a page leads to another freshly generated page
+        The page is streamed as it is generated; media is only referenced, each fetch claims its own asset from the buffer
+
+        Example usage:
+        curl -v --fail -X GET \
+            127.0.0.1:5000/poison/page/some-generated-slug
+        """
+        return Response(core.pages.streamTarpitPage(), mimetype = "text/html")
+
+
+
+def _generateText(numsentences: int, seed: str | None, text_model: markovify.Text | None = None, shingle_index: ShingleIndex | None = None) -> str:
+    # Pull sentences from the model
+    output = core.markov.getXSentences(numsentences, seed, text_model, shingle_index)
+    # If it fails on user number, falls back to three sentences
+    # If that also fails, will return the error message
+    if output[:5] == "ERROR":
+        output = core.markov.getXSentences(3, seed, text_model, shingle_index)
+    return output
+
+
+
+def _textETag(model_version: str, numsentences: int, seed: str) -> str:
+    """
+    Identifies one seeded text response, any change to the model, sentence count or seed gives a new tag
+    """
+    return hashlib.blake2b(f"{model_version}\x1f{numsentences}\x1f{seed}".encode(), digest_size = 12).hexdigest()
+
+
+
+def _zipResponse(claimed: list[str], archive, download_name: str, work_queue: core.admission.WorkQueue, asset_count: int | None = None) -> Response:
+    """
+    Wraps a zip stream as a streamed download
+    Claimed files the stream didn't get to (e.g. on client disconnect) are deleted, and the work queue slot and delivery reservation freed, when the response closes
+    """
+    response = Response(archive, mimetype = "application/zip")
+    response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    response.headers["X-Asset-Count"] = str(asset_count if asset_count is not None else len(claimed))
+    response.call_on_close(lambda: core.filehandling.discardClaimedFiles(claimed))
+    response.call_on_close(lambda: _finish(work_queue, delivery = True))
+    return response
+
+
+
+def _limitUploadSize(max_bytes: int):
+    """
+    Caps the request body before any of it is read
+    A declared Content-Length over the cap is refused straight away, before queueing for a worker; a chunked body is cut off with a 413 as soon as it streams past the cap
+    """
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise RequestEntityTooLarge(f"Uploads are limited to {max_bytes} bytes.")
+    request.max_content_length = max_bytes
+
+
+
+def _admit(queue_name: str, intake: bool = False) -> core.admission.WorkQueue:
+    """
+    Admits the request to the named work queue, optionally also reserving one intake slot
+    Aborts with 429 and a Retry-After header when the server is saturated
+    The caller must pass the returned queue to _finish once its work is done
+    """
+    try:
+        if intake:
+            core.admission.INTAKE_LIMIT.reserve()
+        work_queue = core.admission.WORK_QUEUES[queue_name]
+        try:
+            work_queue.acquire()
+        except:
+            if intake:
+                core.admission.INTAKE_LIMIT.release()
+            raise
+    except core.admission.Overloaded as e:
+        raise TooManyRequests(description = str(e), retry_after = e.retry_after)
+    return work_queue
+
+
+
+def _reserveDelivery():
+    """
+    Reserves one delivery (an audio clip, or a whole batch stream)
+    Aborts with 429 and a Retry-After header when there is no room
+    """
+    try:
+        core.admission.DELIVERY_LIMIT.reserve()
+    except core.admission.Overloaded as e:
+        raise TooManyRequests(description = str(e), retry_after = e.retry_after)
+
+
+
+def _finish(work_queue: core.admission.WorkQueue, intake: bool = False, delivery: bool = False):
+    """
+    Frees everything _admit/_reserveDelivery took for a request
+    """
+    work_queue.release()
+    if intake:
+        core.admission.INTAKE_LIMIT.release()
+    if delivery:
+        core.admission.DELIVERY_LIMIT.release()
@@ -15,6 +15,8 @@ import signal
 from core.messaging import console_out, LogLevel
 from core.markov import initMarkovGenerator
 from core.filehandling import initializeFileBuffers
+from core.metrics import instrumentApp
+from core.profiler import attachProfiler
 
 
 
@@ -33,12 +35,16 @@ app = Flask(__name__)
 # signal.signal(signal.SIGINT, graceful_shutdown)
 
 api.init_app(app)
-
-console_out("Initializing Markov Generator", LogLevel.INFO)
-initMarkovGenerator() # on app load, read in all corpus files
-console_out("Initializing File Buffers", LogLevel.INFO)
-initializeFileBuffers() # on app load, remove any excess files in buffer
-console_out("Running App", LogLevel.INFO)
+instrumentApp(app) # time every request for /monitor/metrics
+attachProfiler(app) # lets /monitor/profiler sample live requests
+
+# when launched as `python app.py`, training worker processes re-import this file as __mp_main__ and must not train themselves
+if __name__ != "__mp_main__":
+    console_out("Initializing Markov Generator", LogLevel.INFO)
+    initMarkovGenerator() # on app load, read in all corpus files
+    console_out("Initializing File Buffers", LogLevel.INFO)
+    initializeFileBuffers() # on app load, remove any excess files in buffer
+    console_out("Running App", LogLevel.INFO)
 
 if __name__ == '__main__':
     # if called by running python file, executes this
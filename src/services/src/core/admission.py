@@ -0,0 +1,104 @@
+"""
+Module to handle admission control and backpressure for expensive endpoints
+"""
+
+### Imports
+# Standard
+import threading
+from contextlib import contextmanager
+
+# Third Party
+
+# Local
+import global_vars
+from core.messaging import console_out, LogLevel
+
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request can't be admitted right now
+    Carries the number of seconds the client should wait before retrying
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+
+class WorkQueue:
+    """
+    Bounded work queue for one media type
+    At most `workers` requests run at once and at most `depth` more may wait for a turn; anything beyond is rejected immediately
+    """
+    def __init__(self, name: str, workers: int, depth: int):
+        self.name = name
+        self._workers = threading.Semaphore(workers)
+        self._slots = threading.BoundedSemaphore(workers + depth)
+
+    def acquire(self):
+        """
+        Takes a place in the queue and waits (up to ADMISSION_WAIT_TIMEOUT) for a worker
+        Raises Overloaded if the queue is full or no worker frees up in time
+        """
+        if not self._slots.acquire(blocking = False):
+            console_out(f"Work queue '{self.name}' is full, rejecting request", LogLevel.WARN)
+            raise Overloaded(f"Server is busy processing {self.name}, try again later", global_vars.ADMISSION_RETRY_AFTER)
+        if not self._workers.acquire(timeout = global_vars.ADMISSION_WAIT_TIMEOUT):
+            self._slots.release()
+            console_out(f"Work queue '{self.name}' timed out waiting for a worker, rejecting request", LogLevel.WARN)
+            raise Overloaded(f"Server is busy processing {self.name}, try again later", global_vars.ADMISSION_RETRY_AFTER)
+
+    def release(self):
+        self._workers.release()
+        self._slots.release()
+
+    @contextmanager
+    def admit(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+
+WORK_QUEUES: dict[str, WorkQueue] = {name: WorkQueue(name, workers, depth) for name, (workers, depth) in global_vars.ADMISSION_LIMITS.items()}
+
+
+
+class CapacityLimit:
+    """
+    Counts units of work in flight (files being processed, files awaiting delivery) against a fixed capacity
+    Every reservation is released by whoever finishes the work, so a failed request can't leave capacity taken up
+    """
+    def __init__(self, name: str, capacity: int, retry_after: int):
+        self.name = name
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, count: int = 1):
+        """
+        Reserves count units, raises Overloaded if there isn't room for all of them
+        """
+        with self._lock:
+            if count <= self.capacity - self.in_use:
+                self.in_use += count
+                return
+        console_out(f"{self.name.capitalize()} is full ({self.in_use} of {self.capacity} in use), rejecting request", LogLevel.WARN)
+        raise Overloaded(f"Server {self.name} is full, try again later", self.retry_after)
+
+    def release(self, count: int = 1):
+        if count <= 0:
+            return
+        with self._lock:
+            self.in_use = max(0, self.in_use - count)
+
+
+
+# uploads (and audio clips) being processed through the intake directory
+INTAKE_LIMIT = CapacityLimit("intake", global_vars.INTAKE_MAX_COUNT, global_vars.ADMISSION_RETRY_AFTER)
+# deliveries in flight: each audio clip or batch stream until its response has been sent (single images are exempt)
+DELIVERY_LIMIT = CapacityLimit("delivery queue", global_vars.DELIVERY_MAX_COUNT, global_vars.ADMISSION_RETRY_AFTER)
@@ -4,20 +4,24 @@ Module to handle audio-specific actions
 
 ### Imports
 # Standard
+import io
+import subprocess
+import tempfile
 import time
 import os
-import random
+from collections.abc import Iterator
 
 # Third Party
 from werkzeug.datastructures import FileStorage
 import filetype
 import pydub # also need to make sure you've installed audioop-lts
-from pydub.utils import make_chunks
+from pydub.exceptions import CouldntDecodeError
 
 # Local
 import global_vars
 from core.messaging import console_out, LogLevel
 import core.filehandling as filehandling
+from core.metrics import timeBlock, observeDuration
 
 
 
@@ -29,60 +33,114 @@ def saveAudioFromPost(audioIn: FileStorage):
     new_file_basename = f"audio_{write_time}.mp3"
 
     # check for type conformity
-    if filetype.is_audio(audioIn):
-        kind = filetype.guess(audioIn)
-        if not (kind and kind.mime == "audio/mpeg"):
-            console_out(f"Uploaded file '{audioIn.filename}' will not be saved: The file is an audio file, but filetype must be 'image/mpeg' e.g. MP3, not '{kind.mime if kind else 'an unknown type'}'.", LogLevel.FAILURE)
-            return [2] # fail because non mpeg audio
-    else:
+    status = checkAudioType(audioIn)
+    if status[0] == 2:
+        console_out(f"Uploaded file '{audioIn.filename}' will not be saved: The file is an audio file, but filetype must be 'image/mpeg' e.g. MP3, not '{status[1]}'.", LogLevel.FAILURE)
+        return [2] # fail because non mpeg audio
+    elif status[0] == 3:
         console_out(f"Uploaded file '{audioIn.filename}' will not be saved: The file is not an audio file.", LogLevel.FAILURE)
         return [3] # fail because nonaudio file
     
     # All below execution is only on correctly-typed files
     new_file_path = filehandling.addFileToBufferDirectory(global_vars.INTAKE_DIRECTORY, new_file_basename, audioIn)
     if new_file_path[:len("Exception: ")] != "Exception: ":
-        subdivideAudio(new_file_path, 1000)
+        try:
+            subdivideAudio(new_file_path, global_vars.AUDIO_CHUNK_LENGTH_MS)
+        except Exception as e:
+            console_out(f"Uploaded file '{audioIn.filename}' will not be saved: The audio could not be chunked: {e}", LogLevel.FAILURE)
+            return [1, str(e)] # fail on undecodable audio or internal error
         return [0] # success, mpeg audio
     
     return [1, new_file_path[len("Exception: "):]] # fail on internal error
     
 
 
+def checkAudioType(audioIn: FileStorage | str) -> list:
+    """
+    Checks an upload or file path is an MP3 without saving it, does not log
+    Returns [0] if it is, [2, detected mime] for other audio, [3] for non-audio files
+    """
+    if not filetype.is_audio(audioIn):
+        return [3]
+    kind = filetype.guess(audioIn)
+    if not (kind and kind.mime == "audio/mpeg"):
+        return [2, kind.mime if kind else "an unknown type"]
+    return [0]
+
+
+
 def getAudioFromBuffer(clip_duration: int):
     """
     Processes audio file from buffer to serve back to API
+    Returns the served path, "File not found" if the buffer is empty, or "Exception: <error>" if the clip could not be saved
     """
-    # get current buffer contents and lower clip_duration if buffer size is less than intended duration
-    audio_buffer = filehandling.listDirectoryFiles(global_vars.AUDIO_DIRECTORY)
-    audio_buffer_size = len(audio_buffer)
-    if clip_duration > audio_buffer_size:
-        clip_duration = audio_buffer_size
+    # claim up to clip_duration chunks, the clip is shorter if the buffer holds fewer
+    selected_files = filehandling.claimFilesFromBuffer(global_vars.AUDIO_DIRECTORY, clip_duration)
+    if not selected_files:
+        return "File not found"
 
     # assemble output file
+    try:
+        output_file = stitchChunks(selected_files)
+    finally:
+        filehandling.discardClaimedFiles(selected_files) # stitchChunks deletes each chunk it loads, this clears any left on failure
+
+    # save output audiosegment to file
+    new_filename = f"audio_clip_{time.time()}.mp3"
+    new_file_path = filehandling.addFileToBufferDirectory(global_vars.INTAKE_DIRECTORY, new_filename, output_file)
+    if new_file_path[:len("Exception: ")] == "Exception: ":
+        # the intake count has already been rolled back, only a partly written file can be left over
+        partial_path = os.path.join(global_vars.INTAKE_DIRECTORY, new_filename)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return new_file_path
+
+    # serve the new segment back to the requester
+    return filehandling.serveFile(new_file_path)
+
+
+
+def getAudioBatchFromBuffer(clip_count: int, clip_duration: int) -> tuple[list[str], Iterator[bytes]]:
+    """
+    Claims enough chunks for clip_count clips of clip_duration seconds in one go
+    Returns the claimed chunk paths and a zip stream that stitches and encodes each clip only when it is reached
+    If the buffer runs short, the final clip is shorter and fewer clips are returned
+    """
+    claimed = filehandling.claimFilesFromBuffer(global_vars.AUDIO_DIRECTORY, clip_count * clip_duration)
+    clip_groups = [claimed[i:i + clip_duration] for i in range(0, len(claimed), clip_duration)]
+    members = ((f"audio_clip_{i}.mp3", _encodeClip(group)) for i, group in enumerate(clip_groups))
+    return claimed, filehandling.streamZipArchive(members)
+
+
+
+def stitchChunks(chunk_paths: list[str]) -> pydub.AudioSegment:
+    """
+    Decodes and concatenates the given chunk files in order, deleting each once it has been loaded
+    """
     output_file: pydub.AudioSegment = None # type: ignore
-    while clip_duration > 0:
-        # select random file in buffer and load into audiosegment
-        selected_basename = random.choice(audio_buffer)
-        selected_file = os.path.join(global_vars.AUDIO_DIRECTORY, selected_basename)
-        working_segment = pydub.AudioSegment.from_file(selected_file)
-        
-        # remove selection from options, as well as buffer
-        audio_buffer.remove(selected_basename)
-        filehandling.deleteResource(selected_file)
-        clip_duration -= 1
+    for chunk_path in chunk_paths:
+        with timeBlock("inferno_ffmpeg_duration_seconds", operation = "decode"):
+            working_segment = pydub.AudioSegment.from_file(chunk_path)
+        filehandling.deleteResource(chunk_path)
 
         # add new segment to the output segment
         if output_file is None:
             output_file = working_segment
         else:
             output_file += working_segment
+    return output_file
 
-    # save output audiosegment to file
-    new_filename = f"audio_clip_{time.time()}.mp3"
-    filehandling.addFileToBufferDirectory(global_vars.INTAKE_DIRECTORY, new_filename, output_file)
 
-    # serve the new segment back to the requester
-    return filehandling.serveFile(os.path.join(global_vars.INTAKE_DIRECTORY, new_filename))
+
+def _encodeClip(chunk_paths: list[str]) -> Iterator[bytes]:
+    """
+    Stitches a clip and yields it as in-memory mp3 bytes, no intake file is written
+    """
+    clip = stitchChunks(chunk_paths)
+    encoded = io.BytesIO()
+    with timeBlock("inferno_ffmpeg_duration_seconds", operation = "encode"):
+        clip.export(encoded, format = "mp3")
+    yield encoded.getvalue()
 
 
 
@@ -90,6 +148,8 @@ def subdivideAudio(audio_file_path: str, chunk_length_ms: int) -> bool:
     """
     Break an audio file (MP3) down into shorter subsections
     Takes the source filepath and subsection length in ms
+    The source file is always deleted. If decoding or saving fails partway, the chunks already written are removed
+    again (so a corrupt upload leaves nothing behind) and the error is raised
     """
     # check path validity
     if not os.path.exists(audio_file_path):
@@ -97,17 +157,59 @@ def subdivideAudio(audio_file_path: str, chunk_length_ms: int) -> bool:
         return False
     file_basename = os.path.basename(audio_file_path)
     
-    # load into audio object
-    audio = pydub.AudioSegment.from_file(audio_file_path, format = "mp3")
-
-    chunks = make_chunks(audio, chunk_length_ms)
     # save the chunks as distinct files
-    for i, chunk in enumerate(chunks):
-        # Name each chunk file sequentially (-4 removes .mp3 from file basename)
-        chunk_name = f"{file_basename[:-4]}_chunk_{i}.mp3"
-        filehandling.addFileToBufferDirectory(global_vars.AUDIO_DIRECTORY, chunk_name, chunk)
-    
-    # remove intake file
-    filehandling.deleteResource(audio_file_path)
+    written: list[str] = []
+    try:
+        for i, chunk in enumerate(chunkAudioFile(audio_file_path, chunk_length_ms)):
+            # Name each chunk file sequentially (-4 removes .mp3 from file basename)
+            chunk_name = f"{file_basename[:-4]}_chunk_{i}.mp3"
+            chunk_path = filehandling.addFileToBufferDirectory(global_vars.AUDIO_DIRECTORY, chunk_name, chunk)
+            if chunk_path[:len("Exception: ")] == "Exception: ":
+                raise OSError(chunk_path[len("Exception: "):])
+            written.append(chunk_path)
+    except Exception:
+        filehandling.discardClaimedFiles(written) # skips any a request has already claimed
+        raise
+    finally:
+        # remove intake file
+        filehandling.deleteResource(audio_file_path)
 
     return True
+
+
+
+def chunkAudioFile(audio_file_path: str, chunk_length_ms: int) -> Iterator[pydub.AudioSegment]:
+    """
+    Decodes an audio file (MP3) and yields it in chunk_length_ms subsections, does not log or touch the buffers
+    PCM is read from an ffmpeg pipe one chunk at a time, so memory use is the same however long the file is
+    Audio is resampled to AUDIO_DECODE_SAMPLE_RATE/AUDIO_DECODE_CHANNELS, since raw PCM carries no header to read them from
+    Stopping early (closing the generator) stops ffmpeg
+    """
+    sample_width = 2 # s16le
+    frame_width = sample_width * global_vars.AUDIO_DECODE_CHANNELS
+    window_size = global_vars.AUDIO_DECODE_SAMPLE_RATE * chunk_length_ms // 1000 * frame_width
+    decode_time = 0.0
+
+    with tempfile.TemporaryFile() as error_log: # a file, not a pipe, so a chatty ffmpeg can never block on stderr
+        process = subprocess.Popen(
+            [pydub.AudioSegment.converter, "-v", "error", "-nostdin", "-f", "mp3", "-i", audio_file_path,
+             "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(global_vars.AUDIO_DECODE_SAMPLE_RATE), "-ac", str(global_vars.AUDIO_DECODE_CHANNELS), "-"],
+            stdout = subprocess.PIPE, stderr = error_log, stdin = subprocess.DEVNULL)
+        try:
+            while True:
+                start = time.perf_counter()
+                window = process.stdout.read(window_size) # type: ignore
+                decode_time += time.perf_counter() - start
+                window = window[:len(window) - len(window) % frame_width]
+                if not window:
+                    break
+                yield pydub.AudioSegment(data = window, sample_width = sample_width, frame_rate = global_vars.AUDIO_DECODE_SAMPLE_RATE, channels = global_vars.AUDIO_DECODE_CHANNELS)
+            if process.wait() != 0:
+                error_log.seek(0)
+                raise CouldntDecodeError(f"Decoding failed. ffmpeg returned error code: {process.returncode}\n\n{error_log.read().decode(errors = 'replace')}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close() # type: ignore
+            process.wait()
+            observeDuration("inferno_ffmpeg_duration_seconds", decode_time, (("operation", "decode"),))
@@ -0,0 +1,214 @@
+"""
+Module to handle importing whole directories of media straight into the buffers, bypassing the API
+"""
+
+### Imports
+# Standard
+import multiprocessing
+import os
+import random
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Third Party
+import markovify
+from PIL import Image
+
+# Local
+import global_vars
+from core.messaging import console_out, LogLevel
+import core.filehandling as filehandling
+import core.images
+import core.audio
+
+
+
+_audio_budget = None # multiprocessing Value, set in each worker process by _initWorker
+
+
+
+def importDirectories(directories: list[str], workers: int = 0) -> dict[str, list[int]]:
+    """
+    Imports every JPG, MP3 and text file found under the given directories, validating and chunking them in worker processes
+    Images and corpora are capped at the room left in their buffers. Audio workers share one chunk budget, the room left in
+    the audio buffer, and files that start once it is used up are skipped without being decoded
+    Buffer counters are recounted once at the end, as on app start
+    Returns {buffer: [files imported, files rejected, files skipped]}
+    """
+    jobs = _collectJobs(directories)
+    workers = workers or os.cpu_count() or 1
+    results: dict[str, list[int]] = {buffer: [0, 0, 0] for buffer in jobs}
+
+    # only import what still fits, so a large archive isn't copied in just to be trimmed back out
+    for buffer, directory, max_count in (("images", global_vars.IMAGE_DIRECTORY, global_vars.IMAGE_MAX_COUNT), ("corpora", global_vars.CORPORA_DIRECTORY, global_vars.CORPUS_MAX_COUNT)):
+        room = max(0, max_count - len(filehandling.listDirectoryFiles(directory)))
+        if len(jobs[buffer]) > room:
+            results[buffer][2] = len(jobs[buffer]) - room
+            jobs[buffer] = jobs[buffer][:room]
+    audio_room = max(0, global_vars.AUDIO_MAX_COUNT - len(filehandling.listDirectoryFiles(global_vars.AUDIO_DIRECTORY)))
+    if audio_room == 0:
+        results["audio"][2] = len(jobs["audio"])
+        jobs["audio"] = []
+    console_out(f"Importing {len(jobs['images'])} image(s), {len(jobs['audio'])} audio file(s) and {len(jobs['corpora'])} corpora across {workers} worker processes", LogLevel.INFO)
+
+    workers_by_buffer: dict[str, Callable] = {"images": _importImage, "audio": _importAudio, "corpora": _importCorpus}
+    prefixes: dict[str, str] = {"images": "image", "audio": "audio", "corpora": "corpus"} # same names as API uploads
+    write_time = time.time()
+    # spawn, not fork, to match training: the log writer thread must not be copied mid-write
+    context = multiprocessing.get_context("spawn")
+    audio_budget = context.Value("i", audio_room) # chunks any worker may still write, shared by all of them
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context, initializer = _initWorker, initargs = (audio_budget,)) as pool:
+        futures = {}
+        for buffer, paths in jobs.items():
+            for i, path in enumerate(paths):
+                future = pool.submit(workers_by_buffer[buffer], path, f"{prefixes[buffer]}_{write_time}_{i}")
+                futures[future] = (buffer, path)
+
+        for future in as_completed(futures):
+            buffer, path = futures[future]
+            status, written = future.result()
+            if status[0] == 0:
+                results[buffer][0] += 1
+                console_out(f"Imported '{path}' into {buffer} ({written} file(s))", LogLevel.SUCCESS)
+            elif status[0] == 5:
+                results[buffer][2] += 1 # the audio budget ran out before this file started
+            else:
+                results[buffer][1] += 1
+                console_out(f"File '{path}' will not be imported: {_describeStatus(buffer, status)}", LogLevel.FAILURE)
+
+    # one recount for the whole import, rather than a counter update per file
+    global_vars.audio_count = filehandling.trimDirectory(global_vars.AUDIO_DIRECTORY, global_vars.AUDIO_MAX_COUNT)
+    global_vars.corpus_count = filehandling.trimDirectory(global_vars.CORPORA_DIRECTORY, global_vars.CORPUS_MAX_COUNT)
+    global_vars.image_count = filehandling.trimDirectory(global_vars.IMAGE_DIRECTORY, global_vars.IMAGE_MAX_COUNT)
+    return results
+
+
+
+def _initWorker(audio_budget):
+    """
+    Runs once in each worker process, keeping the shared audio chunk budget for _importAudio
+    """
+    global _audio_budget
+    _audio_budget = audio_budget
+
+
+
+def _takeAudioChunk() -> bool:
+    """
+    Takes one chunk from the shared audio budget, returns False once it is used up
+    """
+    with _audio_budget.get_lock():
+        if _audio_budget.value <= 0:
+            return False
+        _audio_budget.value -= 1
+        return True
+
+
+
+def _collectJobs(directories: list[str]) -> dict[str, list[str]]:
+    """
+    Walks the given directories and sorts files into buffers by extension, shuffled so capped imports take a random sample
+    """
+    jobs: dict[str, list[str]] = {"images": [], "audio": [], "corpora": []}
+    for directory in directories:
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                buffer = global_vars.IMPORT_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+                if buffer:
+                    jobs[buffer].append(os.path.join(root, filename))
+    for paths in jobs.values():
+        random.shuffle(paths)
+    return jobs
+
+
+
+def _describeStatus(buffer: str, status: list) -> str:
+    match status[0]:
+        case 1:
+            return f"an unexpected error occured: {status[1]}"
+        case 2:
+            return f"filetype must be {'image/jpeg' if buffer == 'images' else 'audio/mpeg'}, not '{status[1]}'"
+        case 3:
+            return "not an image file" if buffer == "images" else "not an audio file" if buffer == "audio" else "not usable UTF-8 text"
+        case 4:
+            return f"the image could not be decoded ({status[1]})"
+    return "bad function return" # this should never happen
+
+
+
+def _importImage(source_path: str, new_file_stem: str) -> tuple[list, int]:
+    """
+    Import worker: validates and re-encodes one image the same way as an upload, straight into the image buffer
+    Runs in a child process, so it must not log or touch runtime globals
+    """
+    try:
+        status = core.images.checkImageType(source_path)
+        if status[0] != 0:
+            return status, 0
+        try:
+            data = core.images.normalizeImage(source_path)
+        except (OSError, Image.DecompressionBombError) as e:
+            return [4, str(e)], 0
+        filehandling.writeFileIntoBuffer(global_vars.IMAGE_DIRECTORY, f"{new_file_stem}.jpg", lambda target: target.write(data))
+        return [0], 1
+    except Exception as e:
+        return [1, str(e)], 0
+
+
+
+def _importAudio(source_path: str, new_file_stem: str) -> tuple[list, int]:
+    """
+    Import worker: validates one audio file the same way as an upload and writes its chunks into the audio buffer
+    Each chunk is taken from the shared budget first, the file stops early when it runs out and is skipped ([5]) if it already has
+    If chunking fails partway, the chunks already written are removed and their budget returned, as subdivideAudio does for uploads
+    Runs in a child process, so it must not log or touch runtime globals
+    """
+    try:
+        if _audio_budget.value <= 0:
+            return [5], 0
+        status = core.audio.checkAudioType(source_path)
+        if status[0] != 0:
+            return status, 0
+        written: list[str] = []
+        taken = 0
+        try:
+            for i, chunk in enumerate(core.audio.chunkAudioFile(source_path, global_vars.AUDIO_CHUNK_LENGTH_MS)):
+                if not _takeAudioChunk():
+                    break
+                taken += 1
+                written.append(filehandling.writeFileIntoBuffer(global_vars.AUDIO_DIRECTORY, f"{new_file_stem}_chunk_{i}.mp3", lambda target: chunk.export(target, format = "mp3")))
+        except Exception:
+            # same as an upload: a file that fails partway leaves no chunks behind, and hands their budget back
+            for path in written:
+                if os.path.exists(path):
+                    os.remove(path)
+            with _audio_budget.get_lock():
+                _audio_budget.value += taken
+            raise
+        if not written and _audio_budget.value <= 0:
+            return [5], 0 # another worker used up the budget while this file was opening
+        return [0], len(written)
+    except Exception as e:
+        return [1, str(e)], 0
+
+
+
+def _importCorpus(source_path: str, new_file_stem: str) -> tuple[list, int]:
+    """
+    Import worker: checks one text file parses into a markov model and copies it into the corpus buffer
+    The model itself is discarded, the app trains on the corpus buffer when it starts
+    Runs in a child process, so it must not log or touch runtime globals
+    """
+    try:
+        try:
+            with open(source_path, encoding = "utf-8") as source:
+                text = source.read()
+        except UnicodeDecodeError:
+            return [3], 0
+        if not markovify.Text(text, retain_original = False).chain.model:
+            return [3], 0
+        filehandling.writeFileIntoBuffer(global_vars.CORPORA_DIRECTORY, new_file_stem, lambda target: target.write(text.encode("utf-8")))
+        return [0], 1
+    except Exception as e:
+        return [1, str(e)], 0
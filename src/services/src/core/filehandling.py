@@ -7,6 +7,9 @@ Module to handle all general file handling actions
 import os
 import threading
 import random
+import tempfile
+import zipfile
+from collections.abc import Callable, Iterable, Iterator
 
 # Third Party
 from werkzeug.datastructures import FileStorage
@@ -15,6 +18,7 @@ from pydub import AudioSegment
 #Local
 from core.messaging import console_out, LogLevel
 import global_vars
+from core.metrics import timeBlock
 
 
 
@@ -99,6 +103,9 @@ def moveFile(file_to_move: str, destination_directory: str) -> str:
     
     new_path = os.path.join(destination_directory, os.path.basename(file_to_move))
     os.rename(file_to_move, new_path)
+    # keep buffer counters in step, these are used for admission control
+    incrementBufferDirectoryCountByPath(f"{os.path.split(file_to_move)[0]}/", True, unsafe = True)
+    incrementBufferDirectoryCountByPath(destination_directory, unsafe = True)
     console_out(f"Successfully changed file location from '{file_to_move}' to '{new_path}'.", LogLevel.SUCCESS)
     return new_path
 
@@ -131,22 +138,111 @@ def serveRandomFileFromBuffer(target_directory: str) -> str:
     """
     Returns the path to a random image in the buffer (for immediate serving), and queues it for local deletion
     """
-    # Choose a random file from the given directory
-    random_file_path = getRandomFileInDirectory(target_directory)
-
-    # Migrates to staging dir and schedules returned file for deletion in 30 seconds (assumes this is sufficient time for a download)
-    if random_file_path != "File not found":
-        staged_path = serveFile(random_file_path)
-        if staged_path == "Invalid path(s)":
-            console_out(f"Failed to serve chosen file '{random_file_path}' due to a bad path.", LogLevel.FAILURE)
-            return "Bad path"
-    else:
+    # Atomically claim a random file from the given directory into the staging dir
+    claimed = claimFilesFromBuffer(target_directory, 1)
+    if not claimed:
         return "File not found"
-    
+    staged_path = claimed[0]
+
+    # Schedules returned file for deletion in 30 seconds (assumes this is sufficient time for a download)
+    timer = threading.Timer(global_vars.FILE_DELETION_DELAY, deleteResource, args = (staged_path,)) 
+    timer.start()
+
     return staged_path
 
 
 
+def claimFilesFromBuffer(target_directory: str, count: int) -> list[str]:
+    """
+    Moves up to count random files from a buffer directory into the delivery directory
+    Each move is a single os.rename, so a file can only ever be claimed by one request, however many run concurrently
+    Returns the delivery paths of the claimed files (empty if the buffer is empty)
+    """
+    candidates = listDirectoryFiles(target_directory)
+    random.shuffle(candidates)
+    claimed: list[str] = []
+    for basename in candidates:
+        if len(claimed) >= count:
+            break
+        new_path = os.path.join(global_vars.DELIVERY_DIRECTORY, basename)
+        try:
+            os.rename(os.path.join(target_directory, basename), new_path)
+        except FileNotFoundError:
+            continue # another request claimed it between the listing and the rename
+        incrementBufferDirectoryCountByPath(target_directory, True)
+        incrementBufferDirectoryCountByPath(global_vars.DELIVERY_DIRECTORY)
+        claimed.append(new_path)
+    console_out(f"Claimed {len(claimed)} of {count} requested file(s) from '{target_directory}'.", LogLevel.SUCCESS)
+    return claimed
+
+
+
+def readFileAndDelete(file_path: str) -> Iterator[bytes]:
+    """
+    Yields a file's contents in STREAM_BLOCK_SIZE blocks, deleting the file once it has been read
+    The file is deleted even if the consumer stops early, since a claimed file must never be served twice
+    """
+    try:
+        with open(file_path, "rb") as file:
+            while block := file.read(global_vars.STREAM_BLOCK_SIZE):
+                yield block
+    finally:
+        deleteResource(file_path)
+
+
+
+class _ZipStreamBuffer:
+    """
+    Write-only sink zipfile can write into, drained after every write so nothing is held on disk or accumulates in memory
+    Not seekable, so zipfile falls back to data descriptors instead of rewriting headers
+    """
+    def __init__(self):
+        self.blocks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.blocks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.blocks)
+        self.blocks.clear()
+        return data
+
+
+
+def streamZipArchive(members: Iterable[tuple[str, Iterable[bytes]]]) -> Iterator[bytes]:
+    """
+    Builds an uncompressed zip archive on the fly and yields it as it is written
+    Takes (name in archive, content blocks) pairs; content is only pulled when its turn comes, so members can be generated lazily
+    """
+    sink = _ZipStreamBuffer()
+    with zipfile.ZipFile(sink, mode = "w", compression = zipfile.ZIP_STORED) as archive: # type: ignore
+        for member_name, blocks in members:
+            with archive.open(member_name, mode = "w", force_zip64 = True) as member:
+                for block in blocks:
+                    member.write(block)
+                    if pending := sink.drain():
+                        yield pending
+            if pending := sink.drain():
+                yield pending
+    if pending := sink.drain():
+        yield pending
+
+
+
+def discardClaimedFiles(file_paths: list[str]):
+    """
+    Deletes any of the given claimed files that were not streamed out, e.g. after a client disconnect
+    """
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            deleteResource(file_path)
+
+
+
 def addFileToBufferDirectory(target_directory: str, new_file_basename: str, file: object) -> str:
     """
     Multi-type function to save a given file object to buffer
@@ -171,7 +267,8 @@ def addFileToBufferDirectory(target_directory: str, new_file_basename: str, file
             case AudioSegment():
                 if dir_is_oversized:
                     deleteResource(getRandomFileInDirectory(target_directory))
-                file.export(new_file_name, format = "mp3")
+                with timeBlock("inferno_ffmpeg_duration_seconds", operation = "encode"):
+                    file.export(new_file_name, format = "mp3")
                 console_out(f"File saved as '{new_file_name}'", LogLevel.SUCCESS)
             case _:
                 console_out(f"File cannot be saved to buffer, is not an accepted type (FileStorage | pydub.AudioSegment).", LogLevel.ERROR, exit_code = 5)       
@@ -184,6 +281,27 @@ def addFileToBufferDirectory(target_directory: str, new_file_basename: str, file
 
 
 
+def writeFileIntoBuffer(target_directory: str, new_file_basename: str, write: Callable) -> str:
+    """
+    Writes a file next to a buffer directory and renames it in, so a running API can never claim it half written
+    Takes the directory, new basename, and a callable that writes the contents to the binary file object it is given
+    Does not log or adjust buffer counters, so it is safe to call from worker processes
+    Returns new file path
+    """
+    staging_directory = os.path.dirname(target_directory.rstrip("/"))
+    with tempfile.NamedTemporaryFile(dir = staging_directory, prefix = ".staging-", delete = False) as target:
+        try:
+            write(target)
+        except:
+            os.remove(target.name)
+            raise
+    os.chmod(target.name, 0o644) # temp files are created owner-only, buffer files are not
+    new_file_name = os.path.join(target_directory, new_file_basename)
+    os.replace(target.name, new_file_name)
+    return new_file_name
+
+
+
 def incrementBufferDirectoryCountByPath(target_directory: str, decrement: bool = False, unsafe: bool = False) -> tuple[int, bool]:
     """
     Adjusts tracking variable for buffer directory sizes
@@ -4,11 +4,19 @@ Module to handle image-specific actions
 
 ### Imports
 # Standard
+import io
+import multiprocessing
+import os
+import random
+import threading
 import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 
 # Third Party
 from werkzeug.datastructures import FileStorage
 import filetype
+from PIL import Image, ImageOps
 
 # Local
 import global_vars
@@ -17,31 +25,126 @@ import core.filehandling as filehandling
 
 
 
+# Re-encoding is CPU bound, so it runs in worker processes rather than on request threads
+_normalize_pool: ProcessPoolExecutor | None = None
+_normalize_pool_lock = threading.Lock()
+
+
+
 def saveImageFromPost(imageIn: FileStorage):
     """
     Validates and saves image POSTed to the API
+    The image is re-encoded by normalizeImage in the worker pool before it enters the buffer
+    Returns [0, original bytes, stored bytes] on success
     """
     write_time = time.time()
     new_file_basename = f"image_{write_time}.jpg"
 
     # check for type conformity
-    if filetype.is_image(imageIn):
-        kind = filetype.guess(imageIn)
-        if not (kind and kind.mime == "image/jpeg"):
-            console_out(f"Uploaded file '{imageIn.filename}' will not be saved: The file is an image, but filetype must be 'image/jpeg' e.g. JPG, not '{kind.mime if kind else 'an unknown type'}'.", LogLevel.FAILURE)
-            return [2] # fail because non jpg image
-    else:
+    status = checkImageType(imageIn)
+    if status[0] == 2:
+        console_out(f"Uploaded file '{imageIn.filename}' will not be saved: The file is an image, but filetype must be 'image/jpeg' e.g. JPG, not '{status[1]}'.", LogLevel.FAILURE)
+        return [2] # fail because non jpg image
+    elif status[0] == 3:
         console_out(f"Uploaded file '{imageIn.filename}' will not be saved: The file is not an image.", LogLevel.FAILURE)
         return [3] # fail because nonimage file
     
     # All below execution is only on correctly-typed files
-    new_file_path = filehandling.addFileToBufferDirectory(global_vars.IMAGE_DIRECTORY, new_file_basename, imageIn)
-    if new_file_path[:len("Exception: ")] == "Exception: ":
-        return [1, new_file_path[len("Exception: "):]] # fail on internal error
-    
-    return [0] # success, jpg image
+    # staged in intake so a worker process can read it
+    intake_path = filehandling.addFileToBufferDirectory(global_vars.INTAKE_DIRECTORY, new_file_basename, imageIn)
+    if intake_path[:len("Exception: ")] == "Exception: ":
+        return [1, intake_path[len("Exception: "):]] # fail on internal error
+
+    try:
+        original_size, stored_size = _getNormalizePool().submit(_normalizeIntoBuffer, intake_path, new_file_basename).result()
+    except (OSError, Image.DecompressionBombError) as e:
+        console_out(f"Uploaded file '{imageIn.filename}' will not be saved: The image could not be decoded ({e}).", LogLevel.FAILURE)
+        return [4] # fail because jpg is corrupt or too large to decode
+    except Exception as e:
+        console_out(f"Could not normalize image '{imageIn.filename}', an unexpected error occured: {e}.", LogLevel.WARN)
+        return [1, str(e)] # fail on internal error
+    finally:
+        filehandling.deleteResource(intake_path)
+
+    # only make room once the new image is in, so a failed upload never costs a buffered one
+    if filehandling.incrementBufferDirectoryCountByPath(global_vars.IMAGE_DIRECTORY)[1]:
+        # never the new image, nor another upload's half-written staging file
+        evictable = [name for name in filehandling.listDirectoryFiles(global_vars.IMAGE_DIRECTORY) if name != new_file_basename and not name.startswith(".")]
+        if evictable:
+            filehandling.deleteResource(os.path.join(global_vars.IMAGE_DIRECTORY, random.choice(evictable)))
+
+    console_out(f"File saved as '{os.path.join(global_vars.IMAGE_DIRECTORY, new_file_basename)}', {original_size} -> {stored_size} bytes ({original_size - stored_size} saved)", LogLevel.SUCCESS)
+    return [0, original_size, stored_size] # success, jpg image
     
 
 
+def checkImageType(imageIn: FileStorage | str) -> list:
+    """
+    Checks an upload or file path is a JPG without saving it, does not log
+    Returns [0] if it is, [2, detected mime] for other images, [3] for non-image files
+    """
+    if not filetype.is_image(imageIn):
+        return [3]
+    kind = filetype.guess(imageIn)
+    if not (kind and kind.mime == "image/jpeg"):
+        return [2, kind.mime if kind else "an unknown type"]
+    return [0]
+
+
+
+def normalizeImage(source: str | io.IOBase) -> bytes:
+    """
+    Re-encodes an image as a progressive JPG no larger than IMAGE_MAX_DIMENSION on either side, with all metadata stripped
+    Does not log or touch the buffers, so it is safe to call from worker processes
+    """
+    max_size = (global_vars.IMAGE_MAX_DIMENSION, global_vars.IMAGE_MAX_DIMENSION)
+    with Image.open(source) as image:
+        image.draft("RGB", max_size) # lets the JPG decoder downscale by up to 8x while decoding
+        image = ImageOps.exif_transpose(image) # keep the orientation the EXIF asked for before the EXIF goes
+        image = image.convert("RGB")
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        image.info = {} # drops EXIF, ICC profile, comments etc. so none of it is written back out
+        output = io.BytesIO()
+        image.save(output, format = "JPEG", quality = global_vars.IMAGE_JPEG_QUALITY, optimize = True, progressive = True)
+    return output.getvalue()
+
+
+
+def _normalizeIntoBuffer(source_path: str, new_file_basename: str) -> tuple[int, int]:
+    """
+    Normalize worker: re-encodes one image straight into the image buffer
+    Runs in a child process, so it must not log or touch runtime globals
+    Returns (original bytes, stored bytes)
+    """
+    data = normalizeImage(source_path)
+    filehandling.writeFileIntoBuffer(global_vars.IMAGE_DIRECTORY, new_file_basename, lambda target: target.write(data))
+    return os.path.getsize(source_path), len(data)
+
+
+
+def _getNormalizePool() -> ProcessPoolExecutor:
+    """
+    Starts the normalize worker pool on first use
+    """
+    global _normalize_pool
+    with _normalize_pool_lock:
+        if _normalize_pool is None:
+            # spawn, not fork: the app already runs threads (log writer, timers) that must not be copied mid-operation
+            _normalize_pool = ProcessPoolExecutor(max_workers = global_vars.IMAGE_NORMALIZE_WORKERS, mp_context = multiprocessing.get_context("spawn"))
+    return _normalize_pool
+
+
+
 def getImageFromBuffer():
-    return filehandling.serveRandomFileFromBuffer(global_vars.IMAGE_DIRECTORY)
\ No newline at end of file
+    return filehandling.serveRandomFileFromBuffer(global_vars.IMAGE_DIRECTORY)
+
+
+
+def getImageBatchFromBuffer(count: int) -> tuple[list[str], Iterator[bytes]]:
+    """
+    Claims up to count images from the buffer in one go and returns them with a zip stream of their contents
+    Each image is deleted as soon as it has been streamed
+    """
+    claimed = filehandling.claimFilesFromBuffer(global_vars.IMAGE_DIRECTORY, count)
+    members = ((os.path.basename(path), filehandling.readFileAndDelete(path)) for path in claimed)
+    return claimed, filehandling.streamZipArchive(members)
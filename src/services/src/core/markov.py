@@ -4,16 +4,32 @@ Module to handle all markov chain/babble actions
 
 ### Imports
 # Standard
+import bisect
+import math
+import multiprocessing
 import os
+import random
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Third Party
 import markovify
+from markovify.chain import BEGIN, END, compile_next
 
 # Local
 import global_vars
 from core.messaging import console_out, LogLevel
 import core.filehandling as filehandling
+from core.metrics import timeBlock
+from core.overlap import ShingleIndex
+
+
+
+MODEL_EPOCH: str = f"{int(time.time()):x}" # restarts retrain the model, so versions are never reused across runs
+_model_revision: int = 0
+_snapshot_lock = threading.Lock() # held only to swap or read the chain, overlap index and version together
+_update_lock = threading.Lock() # serialises addToCorpus, so no update merges into a chain another one is replacing
 
 
 
@@ -21,18 +37,94 @@ import core.filehandling as filehandling
 def initMarkovGenerator():
     console_out("App starting...training markov model on corpora:", LogLevel.INFO)
     global_vars.markov_chain = None
+    global_vars.shingle_index = ShingleIndex()
     files = filehandling.listDirectoryFiles(global_vars.CORPORA_DIRECTORY)
+    if global_vars.TRAINING_MODE == "parallel" and len(files) >= global_vars.TRAINING_PARALLEL_MIN_FILES:
+        trainParallel(files)
+        pruneCorpus()
+        _bumpModelVersion()
+        console_out(f"Markov model trained, overlap index holds {global_vars.shingle_index.shingleCount()} shingles in {global_vars.shingle_index.memoryBytes() // 1024} KiB", LogLevel.SUCCESS)
+        return
+
     for filename in files:
         with open(os.path.join(global_vars.CORPORA_DIRECTORY, filename)) as f:
-            model = markovify.Text(f, retain_original=False)
+            lines = f.readlines()
+            with timeBlock("inferno_markov_duration_seconds", operation = "parse"):
+                model = markovify.Text(lines, retain_original=False)
+            for line in lines:
+                global_vars.shingle_index.addText(line)
             if global_vars.markov_chain:
-                global_vars.markov_chain = markovify.combine(models=[global_vars.markov_chain, model])
+                with timeBlock("inferno_markov_duration_seconds", operation = "merge"):
+                    global_vars.markov_chain = markovify.combine(models=[global_vars.markov_chain, model])
             else:
                 global_vars.markov_chain = model
         console_out(f"\t{filename}", LogLevel.INFO)
         global_vars.corpus_count += 1
     pruneCorpus()
-    console_out("Markov model trained", LogLevel.SUCCESS)
+    _bumpModelVersion()
+    console_out(f"Markov model trained, overlap index holds {global_vars.shingle_index.shingleCount()} shingles in {global_vars.shingle_index.memoryBytes() // 1024} KiB", LogLevel.SUCCESS)
+
+
+def trainParallel(filenames: list[str]):
+    """
+    Map-reduce training for full retrains over large corpora
+    Map: worker processes each parse a batch of corpus files into one chain and overlap index
+    Reduce: partial chains are merged pairwise in a balanced tree, also in the pool, so no model is re-copied more than log2(batches) times
+    """
+    workers = global_vars.TRAINING_WORKERS or os.cpu_count() or 1
+    paths = [os.path.join(global_vars.CORPORA_DIRECTORY, filename) for filename in filenames]
+    batch_size = math.ceil(len(paths) / (workers * global_vars.TRAINING_BATCHES_PER_WORKER))
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    console_out(f"Training on {len(paths)} corpora in {len(batches)} batches across {workers} worker processes", LogLevel.INFO)
+
+    # spawn, not fork: the app already runs threads (log writer, timers) that must not be copied mid-operation
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as pool:
+        with timeBlock("inferno_markov_duration_seconds", operation = "parse"):
+            partials = list(pool.map(_trainBatch, batches))
+
+        chains = [chain for chain, _ in partials if chain]
+        for _, index in partials:
+            global_vars.shingle_index.merge(index)
+
+        with timeBlock("inferno_markov_duration_seconds", operation = "merge"):
+            while len(chains) > 1:
+                pairs = [chains[i:i + 2] for i in range(0, len(chains) - 1, 2)]
+                leftover = chains[-1:] if len(chains) % 2 else []
+                chains = list(pool.map(_mergeChains, pairs)) + leftover
+
+    if chains:
+        global_vars.markov_chain = markovify.Text.from_chain(chains[0])
+    global_vars.corpus_count += len(paths)
+
+
+
+def _trainBatch(paths: list[str]) -> tuple[dict, ShingleIndex]:
+    """
+    Training worker: parses a batch of corpus files into a single chain model dict and overlap index
+    Runs in a child process, so it must not log or touch runtime globals
+    """
+    index = ShingleIndex()
+    models: list[dict] = []
+    for path in paths:
+        with open(path) as f:
+            lines = f.readlines()
+        model = markovify.Text(lines, retain_original=False).chain.model
+        if model:
+            models.append(model)
+        for line in lines:
+            index.addText(line)
+    # combine over a list is a single linear pass, unlike folding models in one at a time
+    chain = markovify.combine(models = models) if models else {}
+    return chain, index
+
+
+
+def _mergeChains(pair: list[dict]) -> dict:
+    """
+    Training worker: merges one pair of chain model dicts for a level of the tree reduction
+    """
+    return markovify.combine(models = pair)
+
 
 
 # corpus directory functions as a FIFO queue based on write timestamps, with the default corpus text protected from deletion
@@ -65,7 +157,7 @@ def pruneCorpus():
 
     
 def addToCorpus(input: str):
-    console_out(f"Adding {input} to corpus", LogLevel.INFO)
+    console_out(f"Adding {len(input)} characters to corpus", LogLevel.INFO)
 
     # create new corpus file with input saved to it
     write_time = time.time()
@@ -73,19 +165,102 @@ def addToCorpus(input: str):
     with open (new_file_path, "w") as file:
         file.write(input)
     # write input into active chain
-    model = markovify.Text(input, retain_original=False)
-    global_vars.markov_chain = markovify.combine(models=[global_vars.markov_chain, model])
+    with timeBlock("inferno_markov_duration_seconds", operation = "parse"):
+        model = markovify.Text(input, retain_original=False)
+    with _update_lock:
+        with timeBlock("inferno_markov_duration_seconds", operation = "merge"):
+            combined = markovify.combine(models=[global_vars.markov_chain, model])
+        # a new index rather than adding to the live one, which readers of the current version are still filtering with
+        shingle_index = global_vars.shingle_index.withText(input)
+        # readers see either the old chain, index and version or the new ones, never a mix
+        with _snapshot_lock:
+            global_vars.markov_chain = combined
+            global_vars.shingle_index = shingle_index
+            _bumpModelVersion()
     # prune oldest if oversized
     pruneCorpus()
 
 
 
-def getXSentences(sentenceCount: int) -> str:
+def getModelSnapshot() -> tuple[markovify.Text, ShingleIndex, str]:
+    """
+    Returns the active chain and overlap index together with their model_version, read as one set
+    Generate from the returned chain and index when the output is tagged with the version, or an update landing in between mislabels it
+    Neither is changed in place once published, so a snapshot keeps giving the same output for as long as it is held
+    """
+    with _snapshot_lock:
+        return global_vars.markov_chain, global_vars.shingle_index, global_vars.model_version
+
+
+
+def getXSentences(sentenceCount: int, seed: str | None = None, text_model: markovify.Text | None = None, shingle_index: ShingleIndex | None = None) -> str:
+    """
+    Generates sentenceCount sentences from the given chain and index (from getModelSnapshot), or the active ones
+    With a seed, the output is the same on every call until the model changes (see global_vars.model_version)
+    """
     console_out(f"Getting {sentenceCount} sentences", LogLevel.INFO)
     output_block: str = ""
-    for _ in range(0, sentenceCount):
-        sentence = global_vars.markov_chain.make_sentence(state_size = 2, test_output = False)
-        if sentence: output_block += f"{sentence} "
+    rng = random.Random(seed) if seed is not None else None
+    with timeBlock("inferno_markov_duration_seconds", operation = "generate"):
+        for _ in range(0, sentenceCount):
+            sentence = makeOriginalSentence(rng, text_model = text_model, shingle_index = shingle_index)
+            if sentence: output_block += f"{sentence} "
     # remove any weird unicode escapes
     output_block = output_block.encode('ascii',errors='ignore').decode('ascii')
-    return output_block or "ERROR: failed to generate in core/markov.py getXSentences()"
\ No newline at end of file
+    return output_block or "ERROR: failed to generate in core/markov.py getXSentences()"
+
+
+
+def makeOriginalSentence(rng: random.Random | None = None, max_chars: int | None = None, text_model: markovify.Text | None = None, shingle_index: ShingleIndex | None = None) -> str | None:
+    """
+    Generates one sentence that doesn't copy the training text verbatim
+    markovify's own originality test needs retain_original=True (the whole corpus in memory), so this
+    checks candidates against the shingle index instead. Returns None if every try overlapped.
+    Given an rng, every choice is drawn from it rather than the shared random module, so the result is reproducible
+    Given max_chars, longer candidates count as failed tries too, like markovify's make_short_sentence
+    Generates from the active chain and checks against the active index unless a text_model and shingle_index are given
+    """
+    text_model = text_model or global_vars.markov_chain
+    shingle_index = shingle_index or global_vars.shingle_index
+    for _ in range(global_vars.SENTENCE_TRIES):
+        if rng is None:
+            sentence = text_model.make_sentence(state_size = 2, test_output = False)
+        else:
+            sentence = text_model.word_join(_walkChain(text_model.chain, rng)) or None
+        if max_chars is not None and sentence and len(sentence) > max_chars:
+            continue
+        if sentence and not shingle_index.overlapsSource(sentence):
+            return sentence
+    return None
+
+
+
+def _walkChain(chain: markovify.Chain, rng: random.Random) -> list[str]:
+    """
+    Same walk as markovify's Chain.walk from the BEGIN state, but drawing from the given generator
+    """
+    begin_state = (BEGIN,) * chain.state_size
+    state = begin_state
+    words: list[str] = []
+    while True:
+        if chain.compiled:
+            choices, cumdist = chain.model[state]
+        elif state == begin_state:
+            choices, cumdist = chain.begin_choices, chain.begin_cumdist
+        else:
+            choices, cumdist = compile_next(chain.model[state])
+        next_word = choices[bisect.bisect(cumdist, rng.random() * cumdist[-1])]
+        if next_word == END:
+            return words
+        words.append(next_word)
+        state = state[1:] + (next_word,)
+
+
+
+def _bumpModelVersion():
+    """
+    Marks the active chain as changed, invalidating seeded output (and its ETags) generated from the old one
+    """
+    global _model_revision
+    _model_revision += 1
+    global_vars.model_version = f"{MODEL_EPOCH}.{_model_revision}"
@@ -5,10 +5,18 @@ Message formatter for all production console output
 ### Imports
 #Standard
 from enum import Enum
+import atexit
+import json
+import queue
+import random
+import sys
+import threading
+import time
 
 # Third Party
 
 # Local
+import global_vars
 from global_vars import Colors
 
 
@@ -26,46 +34,180 @@ class LogLevel(Enum):
 
 
 
+# Severity used for LOG_MIN_LEVEL filtering, higher is more severe
+LOG_LEVEL_SEVERITY: dict[str, int] = {
+    LogLevel.USAGE.name: 10,
+    LogLevel.INFO.name: 20,
+    LogLevel.SUCCESS.name: 20,
+    LogLevel.FAILURE.name: 30,
+    LogLevel.WARN.name: 40,
+    LogLevel.ERROR.name: 50,
+}
+
+# Messages are queued by callers and written by a single background thread
+_log_queue: queue.Queue = queue.Queue(maxsize = global_vars.LOG_QUEUE_MAX_SIZE)
+_writer_thread: threading.Thread | None = None
+_writer_lock = threading.Lock()
+_dropped_count: int = 0
+
+
+
 def console_out(message: str, level: LogLevel, newline: bool = True, exit_code: int = 0, usage: str = ""):
     """
     Standard formatter for logged messages
     All production messages should be run through this
     All debugging messages should be printed normally
     Providing an exit code *will* exit the entire program, so do so only where needed, even for errors
+    Output is written asynchronously; messages below LOG_MIN_LEVEL are discarded and hot-path levels may be sampled
+    """
+    global _dropped_count
+
+    if exit_code == 0:
+        if LOG_LEVEL_SEVERITY[level.name] < LOG_LEVEL_SEVERITY.get(global_vars.LOG_MIN_LEVEL, 0):
+            return
+        sample_rate = global_vars.LOG_SAMPLE_RATES.get(level.name, 1.0)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return
+
+    record = (time.time(), message, level, newline, exit_code, usage)
+    _ensureWriter()
+    try:
+        _log_queue.put_nowait(record)
+    except queue.Full:
+        if exit_code == 0:
+            _dropped_count += 1
+        else:
+            _log_queue.put(record) # never lose the message explaining an exit
+
+    # Kill program on error, once everything queued so far has been written
+    if exit_code != 0:
+        flushLogs()
+        exit(exit_code)
+
+
+
+def flushLogs():
     """
+    Blocks until every queued message has been written
+    """
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _log_queue.join()
+    else:
+        _drainQueue()
+
+
+
+def formatMessage(timestamp: float, message: str, level: LogLevel, newline: bool, exit_code: int, usage: str) -> str:
+    """
+    Renders one queued record in the configured LOG_FORMAT
+    """
+    if global_vars.LOG_FORMAT == "json":
+        entry: dict = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}Z",
+            "level": level.name,
+            "message": message,
+        }
+        if exit_code != 0:
+            entry["exit_code"] = exit_code
+            entry["error"] = _errorDescription(exit_code)
+        if usage != "":
+            entry["usage"] = usage
+        return json.dumps(entry) + "\n"
 
     # Add custom error messages for codes as list expands
-    error_prefix = "ERROR - "
+    error_prefix = ""
+    if exit_code != 0:
+        error_description = _errorDescription(exit_code)
+        error_prefix = f"ERROR - {error_description}\n" if error_description else "ERROR - "
+
+    # Format usage_str
+    if usage != "":
+        usage = f"{Colors.STANDARD_BLUE.value}Usage:{Colors.RESET.value}{Colors.STANDARD_PURPLE.value}{usage}{Colors.RESET.value}\n"
+
+    # Assemble output message with color escapes, with or without newline
+    return f"{usage}{level.value}{error_prefix}{message}{Colors.RESET.value}{chr(10) if newline else ''}"
+
+
+
+def _errorDescription(exit_code: int) -> str:
     match exit_code:
-        case 0:
-            error_prefix = ""
         case 1:
-            error_prefix += "Unknown:\n"
+            return "Unknown:"
         case 2:
-            error_prefix += "Missing Argument(s)\n"
+            return "Missing Argument(s)"
         case 3:
-            error_prefix += "Incorrect Password\n"
+            return "Incorrect Password"
         case 4:
-            error_prefix += "Invalid Input\n"
+            return "Invalid Input"
         case 5:
-            error_prefix += "Bad Filetype\n"
+            return "Bad Filetype"
         case 6:
-            error_prefix += "Bad Path (Dev Fault)\n"
+            return "Bad Path (Dev Fault)"
+    return ""
 
-    # Format usage_str
-    if usage != "":
-        usage = f"{Colors.STANDARD_BLUE.value}Usage:{Colors.RESET.value}{Colors.STANDARD_PURPLE.value}{usage}{Colors.RESET.value}\n"
 
-    # Assemble output message with color escapes
-    output_message = f"{usage}{level.value}{error_prefix}{message}{Colors.RESET.value}"
 
+def _ensureWriter():
+    """
+    Starts the background writer thread on first use
+    """
+    global _writer_thread
+    if _writer_thread is not None:
+        return
+    with _writer_lock:
+        if _writer_thread is None:
+            thread = threading.Thread(target = _writerLoop, name = "console-out-writer", daemon = True)
+            thread.start()
+            _writer_thread = thread
 
-    # Print with or without newline
-    if newline:
-        print(output_message)
-    else:
-        print(output_message, end = "")
-    
-    # Kill program on error
-    if exit_code != 0:
-        exit(exit_code)
+
+
+def _writerLoop():
+    """
+    Writes queued messages in batches, flushing stdout once per batch
+    """
+    while True:
+        batch = [_log_queue.get()]
+        try:
+            while len(batch) < 256:
+                batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        _writeBatch(batch)
+        for _ in batch:
+            _log_queue.task_done()
+
+
+
+def _drainQueue():
+    """
+    Synchronously writes whatever is queued, for use when the writer thread isn't running
+    """
+    batch = []
+    try:
+        while True:
+            batch.append(_log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if batch:
+        _writeBatch(batch)
+        for _ in batch:
+            _log_queue.task_done()
+
+
+
+def _writeBatch(batch: list[tuple]):
+    global _dropped_count
+    lines = [formatMessage(*record) for record in batch]
+    if _dropped_count:
+        dropped, _dropped_count = _dropped_count, 0
+        lines.append(formatMessage(time.time(), f"Log queue full, dropped {dropped} message(s)", LogLevel.WARN, True, 0, ""))
+    try:
+        sys.stdout.write("".join(lines))
+        sys.stdout.flush()
+    except (OSError, ValueError):
+        pass # stdout closed or broken pipe, nothing left to report to
+
+
+
+atexit.register(flushLogs)
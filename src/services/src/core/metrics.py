@@ -0,0 +1,192 @@
+"""
+Low-overhead timing metrics, rendered in Prometheus text format
+"""
+
+### Imports
+# Standard
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Third Party
+from flask import Flask, g, request
+
+# Local
+import global_vars
+
+
+
+# upper bounds (seconds) shared by every histogram, +Inf is implied
+DURATION_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RETIRE_SWEEP_THRESHOLD: int = 64 # sweep finished threads into the shared totals once this many stores exist
+
+HISTOGRAMS: dict[str, str] = {
+    "inferno_http_request_duration_seconds": "Time spent handling an API request, by namespace and route",
+    "inferno_markov_duration_seconds": "Time spent in markovify, by operation (parse, merge, generate)",
+    "inferno_ffmpeg_duration_seconds": "Time spent in pydub/ffmpeg, by operation (decode, encode)",
+}
+
+# Every thread records into its own store, so the hot path never takes a lock
+# A store maps (metric, labels) to [bucket counts..., +Inf count, sum]
+_local = threading.local()
+_stores: list[tuple[threading.Thread, dict]] = []
+_retired: dict = {}
+_stores_lock = threading.Lock()
+
+
+
+def observeDuration(metric: str, seconds: float, labels: tuple[tuple[str, str], ...]):
+    """
+    Records one duration sample against a histogram
+    Labels are passed as a tuple of (name, value) pairs so they can key the store directly
+    """
+    store = getattr(_local, "store", None)
+    if store is None:
+        store = _registerThreadStore()
+    series = store.get((metric, labels))
+    if series is None:
+        series = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+        store[(metric, labels)] = series
+    series[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+    series[-1] += seconds
+
+
+
+@contextmanager
+def timeBlock(metric: str, **labels: str):
+    """
+    Times the enclosed block and records it against the given histogram
+    Example: with timeBlock("inferno_ffmpeg_duration_seconds", operation = "decode"): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observeDuration(metric, time.perf_counter() - start, tuple(labels.items()))
+
+
+
+def instrumentApp(app: Flask):
+    """
+    Installs request hooks that time every request against its matched route
+    Unmatched paths share one label so crawlers can't blow up series cardinality
+    """
+    @app.before_request
+    def _startRequestTimer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _stopRequestTimer(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            namespace = route.strip("/").split("/")[0] if request.url_rule else "unmatched"
+            labels = (("namespace", namespace), ("route", route), ("method", request.method), ("status", str(response.status_code)))
+            observeDuration("inferno_http_request_duration_seconds", time.perf_counter() - start, labels)
+        return response
+
+
+
+def renderMetrics() -> str:
+    """
+    Aggregates all thread stores and buffer counters into Prometheus text exposition format
+    """
+    totals = _collectTotals()
+    lines: list[str] = []
+
+    for metric, help_text in HISTOGRAMS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (series_metric, labels), series in sorted(totals.items()):
+            if series_metric != metric:
+                continue
+            label_text = ",".join(f'{name}="{_escapeLabel(value)}"' for name, value in labels)
+            prefix = f"{label_text}," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, series):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += series[len(DURATION_BUCKETS)]
+            lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{label_text}}} {series[-1]}")
+            lines.append(f"{metric}_count{{{label_text}}} {cumulative}")
+
+    # live buffer gauges, read straight from the tracked counters
+    buffers = (
+        ("corpora", global_vars.corpus_count, global_vars.CORPUS_MAX_COUNT),
+        ("images", global_vars.image_count, global_vars.IMAGE_MAX_COUNT),
+        ("audio", global_vars.audio_count, global_vars.AUDIO_MAX_COUNT),
+        ("intake", global_vars.intake_count, global_vars.INTAKE_MAX_COUNT),
+        ("delivery", global_vars.delivery_count, global_vars.DELIVERY_MAX_COUNT),
+    )
+    lines.append("# HELP inferno_buffer_files Files currently tracked in each buffer directory")
+    lines.append("# TYPE inferno_buffer_files gauge")
+    for name, count, _ in buffers:
+        lines.append(f'inferno_buffer_files{{buffer="{name}"}} {count}')
+    lines.append("# HELP inferno_buffer_capacity Configured maximum file count of each buffer directory")
+    lines.append("# TYPE inferno_buffer_capacity gauge")
+    for name, _, capacity in buffers:
+        lines.append(f'inferno_buffer_capacity{{buffer="{name}"}} {capacity}')
+
+    return "\n".join(lines) + "\n"
+
+
+
+def _registerThreadStore() -> dict:
+    """
+    Creates the calling thread's store and folds any finished threads into the retired totals
+    Only runs once per thread, so the lock stays off the per-sample path
+    """
+    store: dict = {}
+    _local.store = store
+    with _stores_lock:
+        _stores.append((threading.current_thread(), store))
+        if len(_stores) >= RETIRE_SWEEP_THRESHOLD:
+            _sweepFinishedThreads()
+    return store
+
+
+
+def _sweepFinishedThreads():
+    """
+    Merges stores of threads that have exited into _retired and forgets them
+    Caller must hold _stores_lock
+    """
+    alive: list[tuple[threading.Thread, dict]] = []
+    for thread, store in _stores:
+        if thread.is_alive():
+            alive.append((thread, store))
+        else:
+            _mergeStore(_retired, store)
+    _stores[:] = alive
+
+
+
+def _collectTotals() -> dict:
+    """
+    Sums the retired totals and every live thread store into one snapshot
+    """
+    with _stores_lock:
+        _sweepFinishedThreads()
+        totals: dict = {}
+        _mergeStore(totals, _retired)
+        for _, store in _stores:
+            _mergeStore(totals, dict(store))
+    return totals
+
+
+
+def _mergeStore(target: dict, source: dict):
+    for key, series in source.items():
+        existing = target.get(key)
+        if existing is None:
+            target[key] = list(series)
+        else:
+            for i, value in enumerate(series):
+                existing[i] += value
+
+
+
+def _escapeLabel(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,133 @@
+"""
+Module to handle detecting generated sentences that copy the training text verbatim
+"""
+
+### Imports
+# Standard
+import copy
+import hashlib
+import math
+import re
+
+# Third Party
+
+# Local
+import global_vars
+
+
+
+WORD_SPLIT_PATTERN = re.compile(r"\s+") # same split markovify uses for words
+
+
+
+class _BloomLayer:
+    """
+    Fixed-capacity bloom filter over 64-bit hash pairs
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.bit_count = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def add(self, first: int, second: int):
+        for i in range(self.hash_count):
+            position = (first + i * second) % self.bit_count
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, hashes: tuple[int, int]) -> bool:
+        first, second = hashes
+        for i in range(self.hash_count):
+            position = (first + i * second) % self.bit_count
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+
+class ShingleIndex:
+    """
+    Compact fingerprint of every run of shingle_size consecutive words in the training text
+    Backed by a scalable bloom filter (a new, larger layer is added whenever the current one fills), so it
+    never stores the text itself and costs roughly 10 bits per shingle at a 1% false positive rate
+    Stands in for markovify's retain_original/test_output check, which keeps and scans the whole corpus
+    """
+    def __init__(self, shingle_size: int = global_vars.OVERLAP_SHINGLE_SIZE, initial_capacity: int = global_vars.OVERLAP_INITIAL_CAPACITY, error_rate: float = global_vars.OVERLAP_FALSE_POSITIVE_RATE):
+        self.shingle_size = shingle_size
+        self.error_rate = error_rate
+        self.layers: list[_BloomLayer] = [_BloomLayer(initial_capacity, error_rate)]
+
+    def addText(self, text: str):
+        """
+        Fingerprints every shingle in the given text
+        """
+        words = [word for word in WORD_SPLIT_PATTERN.split(text) if word]
+        for i in range(len(words) - self.shingle_size + 1):
+            layer = self.layers[-1]
+            if layer.count >= layer.capacity:
+                layer = _BloomLayer(layer.capacity * 2, self.error_rate)
+                self.layers.append(layer)
+            layer.add(*self._hashShingle(words[i:i + self.shingle_size]))
+
+    def withText(self, text: str) -> "ShingleIndex":
+        """
+        Returns a new index holding this one's shingles plus the given text's, leaving this one unchanged
+        Only the last layer is ever written to, so the full layers before it are shared rather than copied
+        """
+        updated = copy.copy(self)
+        last = copy.copy(self.layers[-1])
+        last.bits = bytearray(last.bits)
+        updated.layers = self.layers[:-1] + [last]
+        updated.addText(text)
+        return updated
+
+    def overlapsSource(self, sentence: str, max_overlap_ratio: float = global_vars.OVERLAP_MAX_RATIO, max_overlap_total: int = global_vars.OVERLAP_MAX_TOTAL) -> bool:
+        """
+        True if the sentence repeats a run of training text longer than markovify would allow:
+        min(max_overlap_total, round(max_overlap_ratio * word count)) words
+        Runs of consecutive known shingles are chained together to measure the copied span
+        Sentences shorter than one shingle can't be checked and always pass
+        """
+        words = [word for word in WORD_SPLIT_PATTERN.split(sentence) if word]
+        overlap_max = min(max_overlap_total, round(max_overlap_ratio * len(words)))
+        if len(words) < self.shingle_size:
+            return False
+
+        run = 0
+        for i in range(len(words) - self.shingle_size + 1):
+            hashes = self._hashShingle(words[i:i + self.shingle_size])
+            if any(hashes in layer for layer in self.layers):
+                run += 1
+                if run + self.shingle_size - 1 > overlap_max:
+                    return True
+            else:
+                run = 0
+        return False
+
+    def merge(self, other: "ShingleIndex"):
+        """
+        Folds another index (e.g. one built in a training worker) into this one
+        Layers are OR-ed into a same-shaped layer with room for them, anything else is kept as an extra layer
+        """
+        for layer in other.layers:
+            target = next((mine for mine in self.layers if mine.bit_count == layer.bit_count and mine.hash_count == layer.hash_count and mine.count + layer.count <= mine.capacity), None)
+            if target is None:
+                self.layers.append(layer)
+                continue
+            merged = int.from_bytes(target.bits, "little") | int.from_bytes(layer.bits, "little")
+            target.bits = bytearray(merged.to_bytes(len(target.bits), "little"))
+            target.count += layer.count
+
+    def memoryBytes(self) -> int:
+        return sum(len(layer.bits) for layer in self.layers)
+
+    def shingleCount(self) -> int:
+        return sum(layer.count for layer in self.layers)
+
+    @staticmethod
+    def _hashShingle(words: list[str]) -> tuple[int, int]:
+        # blake2b rather than hash() so fingerprints are stable across processes
+        digest = hashlib.blake2b("\x1f".join(words).encode(), digest_size = 16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
@@ -0,0 +1,97 @@
+"""
+Module to handle rendering complete tarpit pages
+"""
+
+### Imports
+# Standard
+import random
+import re
+from collections.abc import Iterator
+
+# Third Party
+import jinja2
+
+# Local
+import global_vars
+from core.messaging import console_out, LogLevel
+import core.markov
+
+
+
+SLUG_STRIP_PATTERN = re.compile(r"[^a-z0-9]+")
+
+# Templates are compiled once here and never re-read, every page render reuses the compiled code
+_template_environment = jinja2.Environment(
+    loader = jinja2.FileSystemLoader(global_vars.TEMPLATE_DIRECTORY),
+    autoescape = True,
+    auto_reload = False,
+    trim_blocks = True,
+    lstrip_blocks = True,
+)
+PAGE_TEMPLATE: jinja2.Template = _template_environment.get_template("tarpit_page.html")
+
+
+
+def streamTarpitPage() -> Iterator[str]:
+    """
+    Renders a complete tarpit page as a stream
+    Paragraphs are generated from the markov chain only as the template reaches them, so the first bytes go out immediately
+    Images and audio are referenced by URL, each fetch claims a fresh asset from the buffer
+    """
+    image_count = min(global_vars.PAGE_IMAGE_COUNT, max(global_vars.image_count, 0))
+    audio_count = min(global_vars.PAGE_AUDIO_COUNT, max(global_vars.audio_count, 0) // 3) # a clip needs at least 3 chunks
+    console_out(f"Rendering tarpit page with {image_count} image(s) and {audio_count} clip(s)", LogLevel.USAGE)
+
+    return PAGE_TEMPLATE.generate(
+        title = _makePhrase() or "Untitled",
+        sections = _generateSections(image_count, audio_count),
+        links = _generateLinks(global_vars.PAGE_LINK_COUNT),
+    )
+
+
+
+def _generateSections(image_count: int, audio_count: int) -> Iterator[dict]:
+    """
+    Yields page sections lazily, spreading the media references across random paragraphs
+    """
+    paragraph_count = global_vars.PAGE_PARAGRAPH_COUNT
+    slots = random.sample(range(paragraph_count), min(paragraph_count, image_count + audio_count))
+    image_slots = set(slots[:image_count])
+    audio_slots = set(slots[image_count:])
+    base_url = global_vars.PAGE_ASSET_BASE_URL
+
+    for i in range(paragraph_count):
+        text = core.markov.getXSentences(global_vars.PAGE_SENTENCES_PER_PARAGRAPH)
+        if text[:5] == "ERROR":
+            continue
+        # query strings keep each reference distinct, so crawlers don't de-duplicate the claims
+        yield {
+            "text": text.strip(),
+            "image": f"{base_url}/poison/images?v={random.getrandbits(32):08x}" if i in image_slots else None,
+            "audio": f"{base_url}/poison/audio?v={random.getrandbits(32):08x}" if i in audio_slots else None,
+            "caption": _makePhrase() if i in image_slots or i in audio_slots else "",
+        }
+
+
+
+def _generateLinks(count: int) -> Iterator[dict]:
+    """
+    Yields links to further generated pages, every page links onwards so the graph never ends
+    """
+    base_url = global_vars.PAGE_ASSET_BASE_URL
+    for _ in range(count):
+        text = _makePhrase()
+        if not text:
+            continue
+        slug = SLUG_STRIP_PATTERN.sub("-", text.lower()).strip("-")[:60] or "page"
+        yield {"href": f"{base_url}/poison/page/{slug}-{random.getrandbits(32):08x}", "text": text}
+
+
+
+def _makePhrase() -> str:
+    """
+    Short markov sentence for titles, captions and link text
+    Goes through the same overlap check as paragraphs, so no page text quotes the training data verbatim
+    """
+    phrase = core.markov.makeOriginalSentence(max_chars = 70) or ""
+    return phrase.encode("ascii", errors = "ignore").decode("ascii")
@@ -0,0 +1,163 @@
+"""
+Module to handle on-demand sampling profiles of live requests
+"""
+
+### Imports
+# Standard
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+
+# Third Party
+from flask import Flask, request
+
+# Local
+from core.messaging import console_out, LogLevel
+
+
+
+# thread id -> "METHOD /route" for every request currently being profiled
+_profiled_threads: dict[int, str] = {}
+# collapsed stack ("root;...;leaf") -> sample count
+_stack_counts: Counter = Counter()
+_capture: dict = {"active": False, "fraction": 0.0, "interval": 0.0, "started": 0.0, "deadline": 0.0, "requests": 0, "samples": 0}
+_capture_lock = threading.Lock()
+_stop_event = threading.Event()
+_sampler_thread: threading.Thread | None = None
+
+
+
+def attachProfiler(app: Flask):
+    """
+    Installs request hooks that enrol a random fraction of requests in the running capture
+    Streamed responses stay enrolled while their body is generated, which happens after the handler has returned
+    With no capture running this costs one attribute check per request
+    """
+    @app.before_request
+    def _enrolRequest():
+        if _capture["active"] and random.random() < _capture["fraction"]:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            _profiled_threads[threading.get_ident()] = f"{request.method} {route}"
+            _capture["requests"] += 1
+
+    @app.after_request
+    def _followStream(response):
+        label = _profiled_threads.get(threading.get_ident())
+        if label is not None and response.is_streamed:
+            response.response = _sampleStream(response.response, label)
+        return response
+
+    @app.teardown_request
+    def _releaseRequest(exception = None):
+        _profiled_threads.pop(threading.get_ident(), None)
+
+
+
+def _sampleStream(chunks: Iterable, label: str) -> Iterator:
+    """
+    Wraps a streamed response body so the thread producing each chunk is enrolled under the request's label
+    Only generating a chunk is sampled, not the time spent waiting on the client to take it
+    """
+    iterator = iter(chunks)
+    try:
+        while True:
+            thread_id = threading.get_ident()
+            if _capture["active"]:
+                _profiled_threads[thread_id] = label
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _profiled_threads.pop(thread_id, None)
+            yield chunk
+    finally:
+        # the server closes this wrapper, which must close the real body so its cleanup runs
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+
+def startCapture(fraction: float, duration: float, interval: float) -> dict:
+    """
+    Starts a capture window, discarding any previous results
+    A capture that is already running is stopped and replaced
+    Returns the capture status
+    """
+    global _sampler_thread
+    stopCapture()
+    with _capture_lock:
+        _stack_counts.clear()
+        now = time.time()
+        _capture.update(active = True, fraction = fraction, interval = interval, started = now, deadline = now + duration, requests = 0, samples = 0)
+        _stop_event.clear()
+        _sampler_thread = threading.Thread(target = _samplerLoop, name = "request-profiler", daemon = True)
+        _sampler_thread.start()
+    console_out(f"Profiler capture started: {fraction:.0%} of requests for {duration:g}s", LogLevel.INFO)
+    return captureStatus()
+
+
+
+def stopCapture():
+    """
+    Ends the running capture early, keeping what has been collected
+    """
+    _stop_event.set()
+    if _sampler_thread is not None and _sampler_thread is not threading.current_thread():
+        _sampler_thread.join()
+
+
+
+def captureStatus() -> dict:
+    with _capture_lock:
+        status = dict(_capture)
+        status["distinct_stacks"] = len(_stack_counts)
+    return status
+
+
+
+def collapsedStacks() -> str:
+    """
+    Returns the collected samples in collapsed-stack format (one "frame;frame;frame count" line per stack)
+    This is the input format of flamegraph.pl, speedscope and inferno
+    """
+    with _capture_lock:
+        lines = [f"{stack} {count}" for stack, count in sorted(_stack_counts.items())]
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
+
+def _samplerLoop():
+    """
+    Snapshots the stack of every enrolled request thread each interval until the window closes
+    Runs on its own thread, so profiled requests pay nothing beyond the GIL handoffs
+    """
+    interval = _capture["interval"]
+    while not _stop_event.is_set() and time.time() < _capture["deadline"]:
+        frames = sys._current_frames()
+        samples: list[str] = []
+        for thread_id, label in list(_profiled_threads.items()):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            names: list[str] = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            names.append(label)
+            samples.append(";".join(reversed(names)))
+        del frames
+        with _capture_lock:
+            _stack_counts.update(samples)
+            _capture["samples"] += len(samples)
+        _stop_event.wait(interval)
+
+    with _capture_lock:
+        _capture["active"] = False
+    _profiled_threads.clear()
+    console_out(f"Profiler capture finished with {_capture['samples']} samples", LogLevel.INFO)
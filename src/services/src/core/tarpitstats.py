@@ -0,0 +1,160 @@
+"""
+Module to handle querying and mirroring tarpit stats
+"""
+
+### Imports
+# Standard
+import re
+import threading
+import time
+
+# Third Party
+import requests
+from requests.adapters import HTTPAdapter
+
+# Local
+import global_vars
+from core.messaging import console_out, LogLevel
+
+
+
+BUFFER_PATH_PATTERN = re.compile(r"^stats/buffer(?:/from/(\d+\.\d+))?$")
+
+# one pooled, keep-alive session shared by every passthrough call
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections = 1, pool_maxsize = global_vars.TARPIT_POOL_SIZE))
+_session.mount("https://", HTTPAdapter(pool_connections = 1, pool_maxsize = global_vars.TARPIT_POOL_SIZE))
+
+# path -> (expiry time, decoded response)
+_response_cache: dict[str, tuple[float, object]] = {}
+_cache_lock = threading.Lock()
+
+# local copy of the tarpit's stats/buffer log, kept current with from/<X> pulls
+_buffer_mirror: list[dict] = []
+_buffer_ids: dict[str, int] = {}
+_buffer_last_poll: float = 0.0
+_buffer_last_resync: float = 0.0
+_buffer_lock = threading.Lock()
+
+
+
+def fetchFromTarpit(path: str) -> object:
+    """
+    Makes a single GET to the tarpit over the pooled session and returns the decoded JSON
+    Raises requests.exceptions.RequestException on any connection, timeout or status failure
+    """
+    url = global_vars.TARPIT_STATS_URL.rstrip("/") + "/" + path
+    response = _session.get(url, timeout = (global_vars.TARPIT_CONNECT_TIMEOUT, global_vars.TARPIT_READ_TIMEOUT))
+    response.raise_for_status()
+    try:
+        return response.json()
+    except ValueError as e:
+        raise requests.exceptions.RequestException(f"Tarpit returned non-JSON body for '{path}': {e}")
+
+
+
+def queryTarpit(path: str) -> object:
+    """
+    Returns tarpit stats for the given path (e.g. "stats/agents")
+    Log buffer reads are served from the local mirror, everything else from a short TTL cache
+    Raises requests.exceptions.RequestException if the tarpit has to be reached and cannot be
+    """
+    path = path.strip("/")
+    buffer_match = BUFFER_PATH_PATTERN.match(path)
+    if buffer_match:
+        return getBufferFromMirror(buffer_match.group(1))
+
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _response_cache.get(path)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    data = fetchFromTarpit(path)
+
+    with _cache_lock:
+        if len(_response_cache) >= global_vars.TARPIT_CACHE_MAX_ENTRIES:
+            # drop anything expired, then the oldest insertions if still full
+            for stale_path in [key for key, value in _response_cache.items() if value[0] <= now]:
+                del _response_cache[stale_path]
+            while len(_response_cache) >= global_vars.TARPIT_CACHE_MAX_ENTRIES:
+                del _response_cache[next(iter(_response_cache))]
+        _response_cache[path] = (now + global_vars.TARPIT_CACHE_TTL, data)
+    return data
+
+
+
+def getBufferFromMirror(from_id: str | None = None) -> list[dict]:
+    """
+    Returns the mirrored tarpit log, optionally only entries after the one with id from_id
+    Matches the tarpit's own semantics: an unknown from_id yields an empty list
+    """
+    with _buffer_lock:
+        refreshBufferMirror()
+        if from_id is None:
+            return list(_buffer_mirror)
+        position = _buffer_ids.get(from_id)
+        if position is None:
+            return []
+        return _buffer_mirror[position + 1:]
+
+
+
+def refreshBufferMirror(force: bool = False):
+    """
+    Brings the local log mirror up to date if it is older than the poll interval
+    Each pull re-reads from just before the oldest entry still in progress (or the newest entry), so requests that
+    have since completed get their final stats as well as new entries arriving. Falls back to a full re-read when the
+    tarpit no longer knows that id, and periodically as a backstop
+    Caller must hold _buffer_lock
+    """
+    global _buffer_mirror, _buffer_ids, _buffer_last_poll, _buffer_last_resync
+
+    now = time.monotonic()
+    if not force and now - _buffer_last_poll < global_vars.TARPIT_BUFFER_POLL_INTERVAL:
+        return
+
+    needs_resync = force or now - _buffer_last_resync >= global_vars.TARPIT_BUFFER_RESYNC_INTERVAL
+    anchor = -1
+    if not needs_resync:
+        first_incomplete = next((i for i, entry in enumerate(_buffer_mirror) if not entry.get("complete", True)), len(_buffer_mirror) - 1)
+        anchor = first_incomplete - 1
+    if anchor >= 0:
+        # a known id always returns at least the entry after it, the tarpit answers an unknown one (expired, or the
+        # tarpit restarted) with an empty list, so an empty pull means the mirror has lost its place
+        entries = _asEntryList(fetchFromTarpit(f"stats/buffer/from/{_buffer_mirror[anchor].get('id')}"))
+        if entries:
+            _buffer_mirror[anchor + 1:] = entries
+        else:
+            needs_resync = True
+    else:
+        needs_resync = True # nothing before the oldest open entry to pull from
+    if needs_resync:
+        entries = _asEntryList(fetchFromTarpit("stats/buffer"))
+        _buffer_mirror = entries
+        _buffer_last_resync = now
+        console_out(f"Tarpit log mirror resynced with {len(entries)} entries", LogLevel.INFO)
+
+    # drop anything the tarpit itself has already forgotten
+    expiry = time.time() - global_vars.TARPIT_STATS_REMEMBER_TIME
+    first_kept = 0
+    while first_kept < len(_buffer_mirror) and _buffer_mirror[first_kept].get("when", expiry + 1) <= expiry:
+        first_kept += 1
+    if first_kept or needs_resync:
+        _buffer_mirror = _buffer_mirror[first_kept:]
+        _buffer_ids = {entry.get("id"): i for i, entry in enumerate(_buffer_mirror)}
+    else:
+        for i in range(anchor + 1, len(_buffer_mirror)):
+            _buffer_ids[_buffer_mirror[i].get("id")] = i
+
+    _buffer_last_poll = now
+
+
+
+def _asEntryList(data: object) -> list[dict]:
+    """
+    The tarpit JSON-encodes an empty log as {} rather than [], so normalize to a list
+    """
+    if isinstance(data, list):
+        return data
+    return []
@@ -5,11 +5,15 @@ Globals and hardcoded sample values for program execution
 ### Imports
 # Standard
 from enum import Enum
+import os
+from typing import TYPE_CHECKING
 
 # Third Party
 from markovify import Text as markovText
 
 # Local
+if TYPE_CHECKING:
+    from core.overlap import ShingleIndex # core.overlap imports this module, so only for type checkers
 
 
 
@@ -18,18 +22,92 @@ CORPUS_MAX_COUNT: int = 10001 # 1 is reserved for seed corpus, others are user-g
 IMAGE_MAX_COUNT: int = 5 # TODO: should be 50 for production use
 AUDIO_MAX_COUNT: int = 30 # TODO: should be 50 for production use
 INTAKE_MAX_COUNT: int = 10
-DELIVERY_MAX_COUNT: int = 10
+DELIVERY_MAX_COUNT: int = 10 # audio clip and batch responses being sent at once, a batch counts once however many assets it holds
 FILE_DELETION_DELAY: int = 30 # seconds after serving to delete a file
+BATCH_MAX_COUNT: int = 50 # most assets (images or clips) a single batch request can claim
+STREAM_BLOCK_SIZE: int = 64 * 1024 # bytes read per step when streaming files back to a client
+AUDIO_CHUNK_LENGTH_MS: int = 1000 # uploaded audio is split into buffer chunks of this length
+AUDIO_DECODE_SAMPLE_RATE: int = 44100 # uploads are streamed out of ffmpeg as PCM at this rate...
+AUDIO_DECODE_CHANNELS: int = 2 # ...and channel count
+# Uploaded images are re-encoded before buffering
+IMAGE_UPLOAD_MAX_BYTES: int = 25 * 1024 * 1024 # larger uploads are refused with a 413 as soon as they stream past this
+IMAGE_MAX_DIMENSION: int = 1600 # px, longest side after re-encoding
+IMAGE_JPEG_QUALITY: int = 80
+IMAGE_NORMALIZE_WORKERS: int = int(os.environ.get("IMAGE_NORMALIZE_WORKERS", "2")) # re-encoding worker processes
+# Generated sentences are rejected if they copy the training text verbatim (same limits as markovify's test_output)
+OVERLAP_MAX_RATIO: float = 0.7 # of the generated sentence's word count
+OVERLAP_MAX_TOTAL: int = 15 # words
+OVERLAP_SHINGLE_SIZE: int = 4 # words per fingerprinted run, copies shorter than this go undetected
+OVERLAP_INITIAL_CAPACITY: int = 200000 # shingles before the index grows a new layer
+OVERLAP_FALSE_POSITIVE_RATE: float = 0.01
+SENTENCE_TRIES: int = 10 # generation attempts per sentence before giving up on it
+TEXT_CACHE_MAX_AGE: int = 3600 # seconds proxies may cache seeded text before revalidating it
+# Startup training
+TRAINING_MODE: str = os.environ.get("TRAINING_MODE", "parallel") # "parallel" (process pool, map-reduce) or "serial"
+TRAINING_WORKERS: int = int(os.environ.get("TRAINING_WORKERS", "0")) # 0 uses every core
+TRAINING_PARALLEL_MIN_FILES: int = 64 # smaller corpora train serially, a pool isn't worth starting
+TRAINING_BATCHES_PER_WORKER: int = 4 # corpus is split into this many batches per worker to even out load
+# Bulk import (import_media.py)
+IMPORT_WORKERS: int = int(os.environ.get("IMPORT_WORKERS", "0")) # 0 uses every core
+IMPORT_EXTENSIONS: dict[str, str] = { # file extension -> buffer it is imported into, anything else is skipped
+    ".jpg": "images",
+    ".jpeg": "images",
+    ".mp3": "audio",
+    ".txt": "corpora",
+}
+# Tarpit pages
+PAGE_PARAGRAPH_COUNT: int = 6
+PAGE_SENTENCES_PER_PARAGRAPH: int = 4
+PAGE_LINK_COUNT: int = 12 # links to further generated pages, the graph never ends
+PAGE_IMAGE_COUNT: int = 2 # at most, never more than the image buffer currently holds
+PAGE_AUDIO_COUNT: int = 1 # at most, never more than the audio buffer can fill
+PAGE_ASSET_BASE_URL: str = os.environ.get("PAGE_ASSET_BASE_URL", "") # prefix for asset/link URLs when pages are served from another host
+TEMPLATE_DIRECTORY: str = "templates/"
 # Filepaths
 IMAGE_DIRECTORY: str = "data/buffer/images/"
 AUDIO_DIRECTORY: str = "data/buffer/audio/"
 CORPORA_DIRECTORY: str = "data/buffer/corpora/"
 DELIVERY_DIRECTORY: str = "data/out-for-delivery/"
 INTAKE_DIRECTORY: str = "data/intake/"
+# Admission control for expensive endpoints (text/image GETs are never queued, so they keep priority)
+ADMISSION_LIMITS: dict[str, tuple[int, int]] = { # work queue -> (concurrent workers, further requests allowed to wait)
+    "text": (2, 8),
+    "images": (2, 8),
+    "audio": (2, 4),
+}
+ADMISSION_WAIT_TIMEOUT: float = 5.0 # seconds a queued request waits for a worker before being turned away
+ADMISSION_RETRY_AFTER: int = 5 # seconds suggested to clients turned away from a full work queue
+# Admin
+ADMIN_TOKEN: str = os.environ.get("ADMIN_TOKEN", "") # sent as X-Admin-Token, admin endpoints are disabled while empty. Keep in .secrets.env
+# Request profiler
+PROFILER_DEFAULT_FRACTION: float = 0.1 # share of requests sampled while a capture runs
+PROFILER_DEFAULT_DURATION: float = 60.0 # seconds a capture runs unless told otherwise
+PROFILER_MAX_DURATION: float = 600.0
+PROFILER_SAMPLE_INTERVAL: float = 0.005 # seconds between stack samples of each profiled request
+# Tarpit stats passthrough
+TARPIT_STATS_URL: str = os.environ.get("TARPIT_STATS_URL", "http://division-la.gl.at.ply.gg:8666/") # override to point at a local stand-in tarpit
+TARPIT_CONNECT_TIMEOUT: float = 2.0 # seconds to establish a connection to the tarpit
+TARPIT_READ_TIMEOUT: float = 5.0 # seconds to wait on a tarpit response
+TARPIT_POOL_SIZE: int = 4 # pooled keep-alive connections to the tarpit host
+TARPIT_CACHE_TTL: float = 2.0 # seconds a passthrough response is served from cache
+TARPIT_CACHE_MAX_ENTRIES: int = 256
+TARPIT_BUFFER_POLL_INTERVAL: float = 2.0 # seconds between incremental pulls of the tarpit log
+TARPIT_BUFFER_RESYNC_INTERVAL: float = 300.0 # seconds between full re-reads of the tarpit log
+TARPIT_STATS_REMEMBER_TIME: int = 3600 # matches stats_remember_time in the tarpit config
+# Logging
+LOG_FORMAT: str = os.environ.get("LOG_FORMAT", "ansi") # "ansi" for colored console lines, "json" for one JSON object per line
+LOG_MIN_LEVEL: str = os.environ.get("LOG_MIN_LEVEL", "USAGE") # LogLevel name, anything less severe is discarded
+LOG_QUEUE_MAX_SIZE: int = 10000 # messages waiting on the writer thread before new ones are dropped
+LOG_SAMPLE_RATES: dict[str, float] = { # fraction of messages kept per LogLevel name, for hot-path levels
+    "USAGE": 1.0,
+    "SUCCESS": 1.0,
+}
 
 ### Runtime Vars
 #markov_chain: Optional[markovText] = None
 markov_chain: markovText
+shingle_index: "ShingleIndex" # fingerprints of the training text
+model_version: str = "" # changes whenever markov_chain does, seeded text output is tied to it
 corpus_count: int = 0
 image_count: int = 0
 audio_count: int = 0
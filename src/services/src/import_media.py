@@ -0,0 +1,43 @@
+"""
+Entrypoint for offline bulk media import
+Validates and chunks whole directories of JPG, MP3 and text files in parallel, writing them straight into the buffers
+Run from this directory, like the app. Restart the API afterwards so it retrains on new corpora and recounts its buffers
+
+Example usage:
+python import_media.py ~/archive/images ~/archive/audio ~/archive/text --workers 8
+"""
+
+### Imports
+# Standard
+import argparse
+import os
+
+# Third Party
+
+# Local
+import global_vars
+from core.messaging import console_out, LogLevel
+from core.bulkimport import importDirectories
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Import directories of JPG (.jpg, .jpeg), MP3 (.mp3) and text (.txt) files into the poison buffers")
+    parser.add_argument("directories", nargs = "+", help = "directories to import, searched recursively")
+    parser.add_argument("--workers", type = int, default = global_vars.IMPORT_WORKERS, help = "worker processes (default: IMPORT_WORKERS, or every core)")
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            console_out(f"Cannot import '{directory}', it is not a directory", LogLevel.ERROR, exit_code = 4)
+
+    results = importDirectories(args.directories, args.workers)
+    for buffer, (imported, rejected, skipped) in results.items():
+        console_out(f"{buffer}: {imported} imported, {rejected} rejected, {skipped} skipped (buffer full)", LogLevel.INFO)
+    console_out(f"Buffers now hold {global_vars.image_count} image(s), {global_vars.audio_count} audio chunk(s) and {global_vars.corpus_count} corpora", LogLevel.SUCCESS)
+
+
+
+# worker processes re-import this file as __mp_main__ and must not start an import themselves
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+"""
+Shared test setup: app modules import each other from src/, the same way they do when the API runs
+"""
+
+### Imports
+# Standard
+import os
+import sys
+
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,151 @@
+"""
+Tests for the tarpit stats mirror, run against a local stand-in tarpit
+The stand-in answers stats/buffer and stats/buffer/from/<id> the same way the tarpit's stats.buffer() does
+"""
+
+### Imports
+# Standard
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Third Party
+import pytest
+
+# Local
+import global_vars
+import core.tarpitstats as tarpitstats
+
+
+
+class StandInTarpit:
+    """
+    Minimal tarpit stats server: an in-memory log, with every requested path recorded
+    """
+
+    def __init__(self):
+        self.log: list[dict] = []
+        self.requests: list[str] = []
+        self._next_id = 1
+        tarpit = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.strip("/")
+                tarpit.requests.append(path)
+                if path == "stats/buffer":
+                    body = list(tarpit.log)
+                elif path.startswith("stats/buffer/from/"):
+                    from_id = path[len("stats/buffer/from/"):]
+                    ids = [entry["id"] for entry in tarpit.log]
+                    # an unknown id yields nothing, like the tarpit
+                    body = tarpit.log[ids.index(from_id) + 1:] if from_id in ids else []
+                else:
+                    self.send_error(404)
+                    return
+                # the tarpit encodes an empty log as an object
+                encoded = json.dumps(body or {}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def add(self, complete: bool = True) -> dict:
+        entry = {"id": f"{int(time.time())}.{self._next_id}", "when": int(time.time()), "uri": f"/page/{self._next_id}", "complete": complete, "bytes_sent": 0}
+        self._next_id += 1
+        self.log.append(entry)
+        return entry
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+@pytest.fixture
+def tarpit(monkeypatch):
+    stand_in = StandInTarpit()
+    monkeypatch.setattr(global_vars, "TARPIT_STATS_URL", stand_in.url)
+    monkeypatch.setattr(global_vars, "TARPIT_BUFFER_POLL_INTERVAL", 0.0)
+    monkeypatch.setattr(global_vars, "TARPIT_BUFFER_RESYNC_INTERVAL", 3600.0)
+    monkeypatch.setattr(tarpitstats, "_buffer_mirror", [])
+    monkeypatch.setattr(tarpitstats, "_buffer_ids", {})
+    monkeypatch.setattr(tarpitstats, "_buffer_last_poll", 0.0)
+    monkeypatch.setattr(tarpitstats, "_buffer_last_resync", time.monotonic())
+    yield stand_in
+    stand_in.close()
+
+
+
+def test_new_entries_are_pulled_incrementally(tarpit):
+    for _ in range(3):
+        tarpit.add()
+    assert tarpitstats.getBufferFromMirror() == tarpit.log
+
+    tarpit.requests.clear()
+    tarpit.add()
+    tarpit.add()
+    assert tarpitstats.getBufferFromMirror() == tarpit.log
+    assert tarpit.requests == [f"stats/buffer/from/{tarpit.log[1]['id']}"]
+    assert tarpitstats.getBufferFromMirror(tarpit.log[2]["id"]) == tarpit.log[3:]
+
+
+
+def test_completed_entries_are_refreshed_before_resync(tarpit):
+    tarpit.add()
+    in_progress = tarpit.add(complete = False)
+    tarpit.add(complete = False)
+    tarpitstats.getBufferFromMirror()
+
+    in_progress["complete"] = True
+    in_progress["bytes_sent"] = 4096
+    tarpit.add()
+    tarpit.requests.clear()
+    mirror = tarpitstats.getBufferFromMirror()
+    assert mirror == tarpit.log
+    assert mirror[1]["complete"] and mirror[1]["bytes_sent"] == 4096
+    assert tarpit.requests == [f"stats/buffer/from/{tarpit.log[0]['id']}"]
+
+
+
+def test_idle_polls_do_not_resync(tarpit):
+    for _ in range(3):
+        tarpit.add()
+    tarpitstats.getBufferFromMirror()
+
+    tarpit.requests.clear()
+    for _ in range(3):
+        assert tarpitstats.getBufferFromMirror() == tarpit.log
+    assert "stats/buffer" not in tarpit.requests
+
+
+
+def test_mirror_resyncs_when_tarpit_forgets_its_place(tarpit):
+    for _ in range(3):
+        tarpit.add()
+    tarpitstats.getBufferFromMirror()
+
+    # tarpit restart: the old ids are gone, so from/<id> returns nothing
+    tarpit.log.clear()
+    tarpit.add()
+    tarpit.add()
+    tarpit.requests.clear()
+    assert tarpitstats.getBufferFromMirror() == tarpit.log
+    assert tarpit.requests[-1] == "stats/buffer"
+    assert tarpitstats.getBufferFromMirror(tarpit.log[0]["id"]) == tarpit.log[1:]
+
+
+
+def test_empty_tarpit_log(tarpit):
+    assert tarpitstats.getBufferFromMirror() == []
+    tarpit.add()
+    assert tarpitstats.getBufferFromMirror() == tarpit.log